@@ -17,13 +17,48 @@
 
 
 import os
+import json
+import tempfile
 import unittest
 import logging
+import time
+import socket
+import stat
+import struct
+import threading
+import selectors
+import collections
+import functools
+import io
+import cProfile
+import pstats
+import tracemalloc
 import vtk, qt, ctk, slicer
 from slicer.ScriptedLoadableModule import *
 from slicer.util import VTKObservationMixin
 import numpy as np
 
+# Needle guide workspace in the robot frame: x/z stage travel and insertion depth y [mm]
+NEEDLE_GUIDE_X_RANGE = (-50.0, 50.0)
+NEEDLE_GUIDE_Z_RANGE = (-50.0, 50.0)
+NEEDLE_GUIDE_DEPTH_RANGE = (0.0, 150.0)
+
+# Tilts of the planned insertion axis in the x-y and z-y planes [deg], and number of planned paths displayed
+PLANNED_PATH_ANGLES = (-10.0, -5.0, 0.0, 5.0, 10.0)
+PLANNED_PATH_COUNT = 3
+
+# Deviation of the needle shape from the planned path mapped to the color table [mm]
+SHAPE_DEVIATION_SCALAR_RANGE = (0.0, 5.0)
+
+# Maximum refresh rate of the feedback text boxes [Hz]
+DISPLAY_REFRESH_RATE = 10.0
+
+# Local endpoint re-publishing the decoded feedback: Unix socket path, or host:port where Unix sockets are unavailable
+if hasattr(socket, "AF_UNIX"):
+  FEEDBACK_STREAM_ADDRESS = os.path.join(tempfile.gettempdir(), "SensorizedNeedleFeedback.sock")
+else:
+  FEEDBACK_STREAM_ADDRESS = "localhost:18945"
+
 
 class SensorizedNeedleModule(ScriptedLoadableModule):
   """Uses ScriptedLoadableModule base class, available at:
@@ -54,6 +89,9 @@ class SensorizedNeedleModuleWidget(ScriptedLoadableModuleWidget):
 
   def setup(self):
     ScriptedLoadableModuleWidget.setup(self)
+    
+    # Connector observers and command handlers are wrapped so that they can be profiled on demand
+    self.profiler = ProfilingSession(os.path.join(slicer.app.temporaryPath, "SensorizedNeedleProfiles"))
 
     # ----- Slicer - Open IGT Link GUI ------	
     
@@ -88,7 +126,7 @@ class SensorizedNeedleModuleWidget(ScriptedLoadableModuleWidget):
     self.createServerButton.setMaximumWidth(250)
     
     serverFormLayout.addWidget(self.createServerButton, 2, 0)
-    self.createServerButton.connect('clicked()', self.onCreateServerButtonClicked)
+    self.createServerButton.connect('clicked()', self.profiler.wrap(self.onCreateServerButtonClicked))
 
     self.disconnectFromSocketButton = qt.QPushButton("Disconnect from socket")
     self.disconnectFromSocketButton.toolTip = "Disconnect from the socket"
@@ -96,7 +134,43 @@ class SensorizedNeedleModuleWidget(ScriptedLoadableModuleWidget):
     self.disconnectFromSocketButton.setMaximumWidth(250)
 
     serverFormLayout.addWidget(self.disconnectFromSocketButton, 2, 1)
-    self.disconnectFromSocketButton.connect('clicked()', self.onDisconnectFromSocketButtonClicked)
+    self.disconnectFromSocketButton.connect('clicked()', self.profiler.wrap(self.onDisconnectFromSocketButtonClicked))
+    
+    # Named connection and session profiles, saved on demand. The last session is saved
+    # automatically and restored when the module is set up
+    self.profileStore = SessionProfileStore(os.path.join(os.path.dirname(slicer.app.slicerUserSettingsFilePath), "SensorizedNeedleModule", "profiles.json"))
+    self.profileComboBox = qt.QComboBox()
+    self.profileComboBox.setEditable(True)
+    self.profileComboBox.toolTip = "Select a profile to restore it, or type a new name and save it"
+    self.profileComboBox.addItems(self.profileStore.profileNames() or ["default"])
+    if self.profileStore.lastProfileName is not None:
+      self.profileComboBox.setCurrentIndex(self.profileComboBox.findText(self.profileStore.lastProfileName))
+    self.profileComboBox.setMaximumWidth(250)
+    serverFormLayout.addWidget(qt.QLabel('Session profile:'), 3, 0)
+    serverFormLayout.addWidget(self.profileComboBox, 3, 1)
+    
+    self.saveProfileButton = qt.QPushButton("Save profile")
+    self.saveProfileButton.toolTip = "Save the connection settings, target point and robot state under the profile name"
+    self.saveProfileButton.setMaximumWidth(250)
+    serverFormLayout.addWidget(self.saveProfileButton, 4, 0)
+    self.saveProfileButton.connect('clicked()', self.onSaveProfileButtonClicked)
+    
+    self.restoreProfileButton = qt.QPushButton("Restore profile")
+    self.restoreProfileButton.toolTip = "Restore the connection, target point and robot state of the profile"
+    self.restoreProfileButton.setMaximumWidth(250)
+    serverFormLayout.addWidget(self.restoreProfileButton, 4, 1)
+    self.restoreProfileButton.connect('clicked()', self.onRestoreProfileButtonClicked)
+    
+    self.openIGTNode = None
+    self.IGTActive = False
+    self.robotZeroed = False
+    self.restoringSession = False
+    self.connectorObservers = []
+    # Session changes are coalesced into a single write of the last session
+    self.sessionSaveTimer = qt.QTimer()
+    self.sessionSaveTimer.setSingleShot(True)
+    self.sessionSaveTimer.setInterval(1000)
+    self.sessionSaveTimer.connect('timeout()', self.writeLastSession)
     
     # Initialize observers Button for PoseArray
     #self.IniButton = qt.QPushButton("Initialize")
@@ -165,7 +239,7 @@ class SensorizedNeedleModuleWidget(ScriptedLoadableModuleWidget):
     self.TargetXYZ.addWidget(self.zTargetTextbox)
     outboundLayoutTop.addRow(qt.QLabel("   Target XYZ [mm]:"),self.TargetXYZ)
 
-    self.targetPointNodeSelector.connect('updateFinished()', self.onTargetPointFiducialChanged)
+    self.targetPointNodeSelector.connect('updateFinished()', self.onTargetPointUpdateFinished)
 
 
     #self.skinEntryPointNodeSelector = slicer.qSlicerSimpleMarkupsWidget()
@@ -201,6 +275,32 @@ class SensorizedNeedleModuleWidget(ScriptedLoadableModuleWidget):
     self.SkinEntryXYZ.addWidget(self.zSkinEntryTextbox)
     outboundLayoutTop.addRow(qt.QLabel("   Skin entry XYZ [mm]:"),self.SkinEntryXYZ)
     
+    # Feasibility of the target point in the needle guide workspace
+    self.reachabilityLabel = qt.QLabel("No target point selected")
+    outboundLayoutTop.addRow("   Reachability: ", self.reachabilityLabel)
+    
+    # Precomputed workspace lookup, queried live while the target fiducial is dragged
+    self.workspaceMap = NeedleGuideWorkspaceMap()
+    self.observedTargetPointNode = None
+    self.targetPointObserverTag = None
+    
+    # Candidate skin entry points for the target point, scored in one pass
+    self.trajectoryPlanner = NeedleTrajectoryPlanner(self.workspaceMap)
+    self.plannedPaths = self.trajectoryPlanner.plan(None)
+    self.plannedTarget = None
+    
+    self.planButton = qt.QPushButton("PLAN ENTRY POINTS")
+    self.planButton.toolTip = "Compute skin entry points aligned with the target point (straight and tilted)"
+    self.planButton.enabled = True
+    self.planButton.setMaximumWidth(200)
+    outboundLayoutTop.addRow("   Plan skin entry points: ", self.planButton)
+    self.planButton.connect('clicked()', self.profiler.wrap(self.onPlanButtonClicked))
+    
+    self.plannedPathComboBox = qt.QComboBox()
+    self.plannedPathComboBox.toolTip = "Select the planned path whose skin entry point is published"
+    outboundLayoutTop.addRow("   Planned path: ", self.plannedPathComboBox)
+    self.plannedPathComboBox.connect('currentIndexChanged(int)', self.onPlannedPathSelected)
+    
     #self.skinEntryPointNodeSelector.connect('updateFinished()', self.onSkinEntryPointFiducialChanged)
     
     # Home Button
@@ -210,7 +310,7 @@ class SensorizedNeedleModuleWidget(ScriptedLoadableModuleWidget):
     self.HomeButton.setMaximumWidth(200)
     
     outboundLayoutTop.addRow("   Calibrate linear stages: ", self.HomeButton)
-    self.HomeButton.connect('clicked()', self.onHomeButtonClicked)	
+    self.HomeButton.connect('clicked()', self.profiler.wrap(self.onHomeButtonClicked))	
     
     
     # Move to skin entry aligned with target point Button
@@ -219,7 +319,7 @@ class SensorizedNeedleModuleWidget(ScriptedLoadableModuleWidget):
     self.OriginButton.enabled = True
     self.OriginButton.setMaximumWidth(200)
     outboundLayoutTop.addRow("   Move linear stages to origin: ", self.OriginButton)
-    self.OriginButton.connect('clicked()', self.onOriginButtonClicked)
+    self.OriginButton.connect('clicked()', self.profiler.wrap(self.onOriginButtonClicked))
 
     #Set skin entry to zero of the robot frame
     self.ZeroButton = qt.QPushButton("ZERO")
@@ -227,7 +327,7 @@ class SensorizedNeedleModuleWidget(ScriptedLoadableModuleWidget):
     self.ZeroButton.enabled = True
     self.ZeroButton.setMaximumWidth(200)
     outboundLayoutTop.addRow("   Set actual position the zero of the robot frame: ", self.ZeroButton)
-    self.ZeroButton.connect('clicked()', self.onZeroButtonClicked)
+    self.ZeroButton.connect('clicked()', self.profiler.wrap(self.onZeroButtonClicked))
     
     # Send Target Point Button
     self.sendTargetPointButton = qt.QPushButton("SEND TARGET POINT")
@@ -235,7 +335,7 @@ class SensorizedNeedleModuleWidget(ScriptedLoadableModuleWidget):
     self.sendTargetPointButton.enabled = False
     self.sendTargetPointButton.setMaximumWidth(200)
     outboundLayoutTop.addRow("   Publish Skin Entry coordinates : ", self.sendTargetPointButton)
-    self.sendTargetPointButton.connect('clicked()', self.onsendTargetPointButtonClicked)	
+    self.sendTargetPointButton.connect('clicked()', self.profiler.wrap(self.onsendTargetPointButtonClicked))	
     
     # Send Skin Entry Point Button
     self.sendSkinEntryPointButton = qt.QPushButton("SEND SKIN ENTRY POINT")
@@ -243,7 +343,7 @@ class SensorizedNeedleModuleWidget(ScriptedLoadableModuleWidget):
     self.sendSkinEntryPointButton.enabled = False
     self.sendSkinEntryPointButton.setMaximumWidth(200)
     outboundLayoutTop.addRow("   Publish Skin Entry coordinates : ",self.sendSkinEntryPointButton)
-    self.sendSkinEntryPointButton.connect('clicked()', self.onsendSkinEntryPointButtonClicked)
+    self.sendSkinEntryPointButton.connect('clicked()', self.profiler.wrap(self.onsendSkinEntryPointButtonClicked))
 	
     # Stop Button
     self.StopButton = qt.QPushButton("STOP")
@@ -252,7 +352,7 @@ class SensorizedNeedleModuleWidget(ScriptedLoadableModuleWidget):
     self.StopButton.setMaximumWidth(200)
     self.StopButton.setStyleSheet('QPushButton {color: red;}')
     outboundLayoutTop.addRow("   Stop Robot: ", self.StopButton)
-    self.StopButton.connect('clicked()', self.onStopButtonClicked)	
+    self.StopButton.connect('clicked()', self.profiler.wrap(self.onStopButtonClicked))	
     
     
     # Visibility icon planned path needle
@@ -290,6 +390,33 @@ class SensorizedNeedleModuleWidget(ScriptedLoadableModuleWidget):
     self.dthetaTextbox.setFixedWidth(200)
     modelFormLayout.addRow("   dθ:", self.dthetaTextbox)
     
+    # Timing of the model output: time since the last instruction, update rate and lag behind the newest shape
+    self.instructionAgeTextbox = qt.QLineEdit("")
+    self.instructionAgeTextbox.setReadOnly(True)
+    self.instructionRateTextbox = qt.QLineEdit("")
+    self.instructionRateTextbox.setReadOnly(True)
+    self.instructionLagTextbox = qt.QLineEdit("")
+    self.instructionLagTextbox.setReadOnly(True)
+    
+    self.InstructionTiming = qt.QHBoxLayout()
+    self.InstructionTiming.addWidget(self.instructionAgeTextbox)
+    self.InstructionTiming.addWidget(self.instructionRateTextbox)
+    self.InstructionTiming.addWidget(self.instructionLagTextbox)
+    modelFormLayout.addRow("   Age [s], rate [Hz], lag [frames]:", self.InstructionTiming)
+    
+    self.maxInstructionLagSpinBox = qt.QSpinBox()
+    self.maxInstructionLagSpinBox.setRange(0, 1000)
+    self.maxInstructionLagSpinBox.value = 2
+    self.maxInstructionLagSpinBox.toolTip = "Flag the instruction when the model output lags behind the newest shape by more frames"
+    modelFormLayout.addRow("   Max lag [frames]:", self.maxInstructionLagSpinBox)
+    
+    self.instructionFeed = InstructionFeed()
+    self.instructionLagging = False
+    # Age keeps increasing between instructions
+    self.instructionStatusTimer = qt.QTimer()
+    self.instructionStatusTimer.setInterval(200)
+    self.instructionStatusTimer.connect('timeout()', self.updateInstructionStatus)
+    
     
     # Needle Guide state collapsible button
     NeedleGuideCollapsibleButton = ctk.ctkCollapsibleButton()
@@ -359,9 +486,163 @@ class SensorizedNeedleModuleWidget(ScriptedLoadableModuleWidget):
     self.NeedleEndXYZ.addWidget(self.zNeedleEndTextbox)
     NeedleShapeGridLayout.addRow(qt.QLabel("   End point position of the needle shape:"),self.NeedleEndXYZ)
     
+    self.maxDeviationTextbox = qt.QLineEdit("No planned path selected")
+    self.maxDeviationTextbox.setReadOnly(True)
+    self.maxDeviationTextbox.setFixedWidth(200)
+    NeedleShapeGridLayout.addRow("   Max deviation from planned path [mm]:", self.maxDeviationTextbox)
+    
+    # Per-point deviation of the received shape from the selected planned path
+    self.shapeDeviation = NeedleShapeDeviation()
+    self.deviationPolyData = None
+    self.deviationBufferVersion = -1
+    self.deviationPointCount = 0
+    
+    # ----- Needle shape filter GUI------
+    shapeFilterCollapsibleButton = ctk.ctkCollapsibleButton()
+    shapeFilterCollapsibleButton.text = "Needle shape filter and display"
+    shapeFilterCollapsibleButton.collapsed = True
+    self.layout.addWidget(shapeFilterCollapsibleButton)
+    
+    shapeFilterFormLayout = qt.QFormLayout(shapeFilterCollapsibleButton)
+    
+    # Filter between the decoded shape poses and the display
+    self.shapeFilter = NeedleShapeFilter()
+    
+    self.temporalFilterComboBox = qt.QComboBox()
+    self.temporalFilterComboBox.addItems(["None", "EMA", "Kalman (tip)"])
+    self.temporalFilterComboBox.toolTip = "Temporal smoothing across consecutive needle shapes"
+    shapeFilterFormLayout.addRow("   Temporal smoothing:", self.temporalFilterComboBox)
+    
+    self.emaAlphaSpinBox = qt.QDoubleSpinBox()
+    self.emaAlphaSpinBox.setRange(0.05, 1.0)
+    self.emaAlphaSpinBox.setSingleStep(0.05)
+    self.emaAlphaSpinBox.value = self.shapeFilter.emaAlpha
+    self.emaAlphaSpinBox.toolTip = "Weight of the newest shape in the exponential moving average"
+    shapeFilterFormLayout.addRow("   EMA weight:", self.emaAlphaSpinBox)
+    
+    self.splineFitCheckBox = qt.QCheckBox()
+    self.splineFitCheckBox.checked = self.shapeFilter.splineFit
+    self.splineFitCheckBox.toolTip = "Fit a cubic B-spline along the needle shape"
+    shapeFilterFormLayout.addRow("   Spline fitting:", self.splineFitCheckBox)
+    
+    self.maxPoseCountJumpSpinBox = qt.QSpinBox()
+    self.maxPoseCountJumpSpinBox.setRange(0, 1000)
+    self.maxPoseCountJumpSpinBox.value = self.shapeFilter.maxPoseCountJump
+    self.maxPoseCountJumpSpinBox.toolTip = "Reject shapes whose number of poses changes by more than this value"
+    shapeFilterFormLayout.addRow("   Max nb of poses jump:", self.maxPoseCountJumpSpinBox)
+    
+    self.maxPointJumpSpinBox = qt.QDoubleSpinBox()
+    self.maxPointJumpSpinBox.setRange(0.0, 1000.0)
+    self.maxPointJumpSpinBox.value = self.shapeFilter.maxPointJump
+    self.maxPointJumpSpinBox.toolTip = "Reject shapes with a point moving by more than this distance"
+    shapeFilterFormLayout.addRow("   Max point jump [mm]:", self.maxPointJumpSpinBox)
+    
+    self.displayToleranceSpinBox = qt.QDoubleSpinBox()
+    self.displayToleranceSpinBox.setRange(0.0, 10.0)
+    self.displayToleranceSpinBox.setSingleStep(0.05)
+    self.displayToleranceSpinBox.value = self.shapeFilter.displayTolerance
+    self.displayToleranceSpinBox.toolTip = "Skip display updates of shapes moving less than this distance"
+    shapeFilterFormLayout.addRow("   Display tolerance [mm]:", self.displayToleranceSpinBox)
+    
+    self.temporalFilterComboBox.connect('currentIndexChanged(int)', self.onShapeFilterParameterChanged)
+    self.emaAlphaSpinBox.connect('valueChanged(double)', self.onShapeFilterParameterChanged)
+    self.splineFitCheckBox.connect('toggled(bool)', self.onShapeFilterParameterChanged)
+    self.maxPoseCountJumpSpinBox.connect('valueChanged(int)', self.onShapeFilterParameterChanged)
+    self.maxPointJumpSpinBox.connect('valueChanged(double)', self.onShapeFilterParameterChanged)
+    self.displayToleranceSpinBox.connect('valueChanged(double)', self.onShapeFilterParameterChanged)
+    
+    # Feedback text boxes are written only when their displayed text changes, at a capped rate
+    self.textboxBinding = TextboxDisplayBinding()
+    self.textboxBinding.bind("dz", self.dzTextbox)
+    self.textboxBinding.bind("dtheta", self.dthetaTextbox)
+    self.textboxBinding.bind("x", self.xTextbox)
+    self.textboxBinding.bind("y", self.yTextbox)
+    self.textboxBinding.bind("z", self.zTextbox)
+    self.textboxBinding.bind("theta", self.thetaTextbox)
+    self.textboxBinding.bind("xNeedleEnd", self.xNeedleEndTextbox)
+    self.textboxBinding.bind("yNeedleEnd", self.yNeedleEndTextbox)
+    self.textboxBinding.bind("zNeedleEnd", self.zNeedleEndTextbox)
+    self.textboxBinding.bind("maxDeviation", self.maxDeviationTextbox)
+    self.textboxBinding.bind("instruction", self.instructionTextbox, None)
+    self.textboxBinding.bind("instructionAge", self.instructionAgeTextbox)
+    self.textboxBinding.bind("instructionRate", self.instructionRateTextbox, 1)
+    self.textboxBinding.bind("instructionLag", self.instructionLagTextbox, 0)
+    
+    self.refreshRateSpinBox = qt.QDoubleSpinBox()
+    self.refreshRateSpinBox.setRange(1.0, 60.0)
+    self.refreshRateSpinBox.value = DISPLAY_REFRESH_RATE
+    self.refreshRateSpinBox.toolTip = "Maximum refresh rate of the feedback text boxes"
+    shapeFilterFormLayout.addRow("   Text refresh rate [Hz]:", self.refreshRateSpinBox)
+    self.refreshRateSpinBox.connect('valueChanged(double)', self.textboxBinding.setRefreshRate)
+    
+    # ----- Feedback stream export GUI------
+    feedbackStreamCollapsibleButton = ctk.ctkCollapsibleButton()
+    feedbackStreamCollapsibleButton.text = "Feedback stream export"
+    feedbackStreamCollapsibleButton.collapsed = True
+    self.layout.addWidget(feedbackStreamCollapsibleButton)
+    
+    feedbackStreamFormLayout = qt.QFormLayout(feedbackStreamCollapsibleButton)
+    
+    # Decoded pose and filtered shape frames re-published to local subscribers
+    self.feedbackPublisher = FeedbackStreamPublisher()
+    
+    self.feedbackStreamAddressTextbox = qt.QLineEdit(FEEDBACK_STREAM_ADDRESS)
+    self.feedbackStreamAddressTextbox.toolTip = "Unix socket path, or host:port for a local TCP endpoint"
+    feedbackStreamFormLayout.addRow("   Stream address:", self.feedbackStreamAddressTextbox)
+    
+    self.publishFeedbackStreamButton = qt.QPushButton("Publish feedback stream")
+    self.publishFeedbackStreamButton.toolTip = "Re-publish the needle pose and shape to local subscribers"
+    self.publishFeedbackStreamButton.setCheckable(True)
+    self.publishFeedbackStreamButton.setMaximumWidth(200)
+    feedbackStreamFormLayout.addRow("   Export:", self.publishFeedbackStreamButton)
+    self.publishFeedbackStreamButton.connect('toggled(bool)', self.onPublishFeedbackStreamToggled)
+    
+    # ----- Profiling GUI------
+    profilingCollapsibleButton = ctk.ctkCollapsibleButton()
+    profilingCollapsibleButton.text = "Profiling"
+    profilingCollapsibleButton.collapsed = True
+    self.layout.addWidget(profilingCollapsibleButton)
+    
+    profilingFormLayout = qt.QFormLayout(profilingCollapsibleButton)
+    
+    self.profilingWindowSpinBox = qt.QDoubleSpinBox()
+    self.profilingWindowSpinBox.setRange(1.0, 600.0)
+    self.profilingWindowSpinBox.value = 10.0
+    self.profilingWindowSpinBox.toolTip = "Duration of the profiling window"
+    profilingFormLayout.addRow("   Window [s]:", self.profilingWindowSpinBox)
+    
+    self.profilingTopCountSpinBox = qt.QSpinBox()
+    self.profilingTopCountSpinBox.setRange(1, 500)
+    self.profilingTopCountSpinBox.value = self.profiler.topCount
+    self.profilingTopCountSpinBox.toolTip = "Number of hot functions and allocation sites in the summary"
+    profilingFormLayout.addRow("   Summary entries:", self.profilingTopCountSpinBox)
+    
+    self.profilingButton = qt.QPushButton("Start profiling")
+    self.profilingButton.toolTip = "Profile the connector observers and command handlers with cProfile and tracemalloc (Ctrl+Alt+P)"
+    self.profilingButton.setCheckable(True)
+    self.profilingButton.setMaximumWidth(200)
+    profilingFormLayout.addRow("   Profiling:", self.profilingButton)
+    self.profilingButton.connect('toggled(bool)', self.onProfilingButtonToggled)
+    
+    self.profilingOutputLabel = qt.QLabel("")
+    self.profilingOutputLabel.setTextInteractionFlags(qt.Qt.TextSelectableByMouse)
+    profilingFormLayout.addRow("   Last summary:", self.profilingOutputLabel)
+    
+    self.profilingTimer = qt.QTimer()
+    self.profilingTimer.setSingleShot(True)
+    self.profilingTimer.connect('timeout()', self.onProfilingWindowElapsed)
+    
+    self.profilingShortcut = qt.QShortcut(qt.QKeySequence("Ctrl+Alt+P"), slicer.util.mainWindow())
+    self.profilingShortcut.connect('activated()', self.onProfilingShortcutActivated)
+    
+    # Restore the last session once the widgets are attached to the scene
+    qt.QTimer.singleShot(0, self.restoreLastSession)
+    
+    
     # Define empty Nodes 
     self.PlannedPathTransform = None
     self.XStageTransform = None
+    self.pointerPolyData = None
     #XStageMatrix = vtk.vtkMatrix4x4()
     #XStageMatrix.Identity()
     #self.XStageTransform.SetMatrixTransformToParent(XStageMatrix)
@@ -394,7 +675,24 @@ class SensorizedNeedleModuleWidget(ScriptedLoadableModuleWidget):
   def onCreateServerButtonClicked(self):
     snrPort = self.snrPortTextbox.text
     snrHostname = self.snrHostnameTextbox.text
-    print("Slicer-side port number: ", snrPort)
+    try:
+      snrPortNumber = int(snrPort)
+    except ValueError:
+      snrPortNumber = -1
+    if not 0 < snrPortNumber < 65536:
+      print("Error: Invalid Slicer-side port number: ", snrPort)
+      return
+    print("Slicer-side port number: ", snrPortNumber)
+    # Initialize the IGTLink Slicer-side server component, the connector node is reused on reconnection
+    if self.openIGTNode is None or slicer.mrmlScene.GetNodeByID(self.openIGTNode.GetID()) is None:
+      self.openIGTNode = slicer.vtkMRMLIGTLConnectorNode()
+      slicer.mrmlScene.AddNode(self.openIGTNode)
+    self.openIGTNode.SetTypeServer(snrPortNumber)
+    self.IGTActive = bool(self.openIGTNode.Start())
+    print("openIGTNode: ", self.openIGTNode)
+    if not self.IGTActive:
+      print("Error: OpenIGTLink server could not be started on port: ", snrPortNumber)
+      return
     #VisualFeedback: color in gray when server is created
     self.snrPortTextboxLabel.setStyleSheet('color: rgb(195,195,195)')
     self.snrHostnameTextboxLabel.setStyleSheet('color: rgb(195,195,195)')
@@ -403,53 +701,60 @@ class SensorizedNeedleModuleWidget(ScriptedLoadableModuleWidget):
     # Disable textboxes
     self.snrPortTextbox.setReadOnly(True)
     self.snrHostnameTextbox.setReadOnly(True)
-    # Initialize the IGTLink Slicer-side server component
-    self.openIGTNode = slicer.vtkMRMLIGTLConnectorNode()
-    slicer.mrmlScene.AddNode(self.openIGTNode)
-    self.openIGTNode.SetTypeServer(int(snrPort))
-    self.openIGTNode.Start()
-    print("openIGTNode: ", self.openIGTNode)
-    self.IGTActive = True
     
     # Make a node for each parameter type
     #ReceivedStringMsg = slicer.vtkMRMLTextNode()
     #ReceivedStringMsg.SetName("StringMessage")
     #slicer.mrmlScene.AddNode(ReceivedStringMsg)
     
-    ReceivedNeedlePose = slicer.vtkMRMLTextNode()
-    ReceivedNeedlePose.SetName("/stage/state/needle")
-    slicer.mrmlScene.AddNode(ReceivedNeedlePose)
+    ReceivedNeedlePose = self.getOrCreateNode("vtkMRMLTextNode", "/stage/state/needle")
+    
+    ReceivedInstruction = self.getOrCreateNode("vtkMRMLTextNode", "/estimation/instruction")
     
-    ReceivedStringNewShape = slicer.vtkMRMLTextNode()
-    ReceivedStringNewShape.SetName("NewShape")
-    slicer.mrmlScene.AddNode(ReceivedStringNewShape)
+    ReceivedStringNewShape = self.getOrCreateNode("vtkMRMLTextNode", "NewShape")
     
     #ReceivedNeedleShape0 = slicer.vtkMRMLLinearTransformNode()
     #ReceivedNeedleShape0.SetName("currentshape_0")
     #slicer.mrmlScene.AddNode(ReceivedNeedleShape0)
     
-    XStageTransform = slicer.vtkMRMLLinearTransformNode()
-    XStageTransform.SetName("XStageTransform")
-    slicer.mrmlScene.AddNode(XStageTransform)
+    self.getOrCreateNode("vtkMRMLLinearTransformNode", "XStageTransform")
     
     #Add node for Needle Shape curve
-    CurveNeedleShapeNode = slicer.vtkMRMLMarkupsCurveNode()
-    CurveNeedleShapeNode.SetName("CurveNeedleShape")
-    slicer.mrmlScene.AddNode(CurveNeedleShapeNode)  
+    self.getOrCreateNode("vtkMRMLMarkupsCurveNode", "CurveNeedleShape")
     
     #Add node for Needle Shape fiducials
     #FiducialsNeedleShapeNode = slicer.vtkMRMLMarkupsFiducialNode()
     #FiducialsNeedleShapeNode.SetName("FiducialsNeedleShape")
     #slicer.mrmlScene.AddNode(FiducialsNeedleShapeNode)  
     
-    # Add observers on the message type nodes
-    ReceivedStringNewShape.AddObserver(slicer.vtkMRMLTextNode.TextModifiedEvent, self.onNeedleShapeNodeModified)
+    # Add observers on the message type nodes, once per node when reconnecting
+    self.removeConnectorObservers()
+    self.addConnectorObserver(ReceivedStringNewShape, slicer.vtkMRMLTextNode.TextModifiedEvent, self.onNeedleShapeNodeModified)
     
-    ReceivedNeedlePose.AddObserver(slicer.vtkMRMLTextNode.TextModifiedEvent, self.onNeedlePoseNodeModified)
+    self.addConnectorObserver(ReceivedNeedlePose, slicer.vtkMRMLTextNode.TextModifiedEvent, self.onNeedlePoseNodeModified)
+    
+    self.addConnectorObserver(ReceivedInstruction, slicer.vtkMRMLTextNode.TextModifiedEvent, self.onInstructionNodeModified)
     #ReceivedNeedleShape0.AddObserver(slicer.vtkMRMLTransformNode.TransformModifiedEvent, self.onNeedleShapeNodeModified)
+    self.saveSession()
+    
+  def getOrCreateNode(self, className, nodeName):
+    node = slicer.mrmlScene.GetFirstNodeByName(nodeName)
+    if node is None:
+      node = slicer.mrmlScene.AddNewNodeByClass(className, nodeName)
+    return node
+    
+  def addConnectorObserver(self, node, event, callback):
+    self.connectorObservers.append((node, node.AddObserver(event, self.profiler.wrap(callback))))
+    
+  def removeConnectorObservers(self):
+    for node, tag in self.connectorObservers:
+      node.RemoveObserver(tag)
+    self.connectorObservers = []
     
   def onDisconnectFromSocketButtonClicked(self):
-    self.openIGTNode.Stop()
+    if self.openIGTNode is not None:
+      self.openIGTNode.Stop()
+    self.IGTActive = False
     #VisualFeedback: color in black when socket is disconnected
     self.snrPortTextboxLabel.setStyleSheet('color: black')
     self.snrHostnameTextboxLabel.setStyleSheet('color: black')
@@ -458,6 +763,165 @@ class SensorizedNeedleModuleWidget(ScriptedLoadableModuleWidget):
     # Enable textboxes
     self.snrPortTextbox.setReadOnly(False)
     self.snrHostnameTextbox.setReadOnly(False)
+    self.saveSession()
+    
+  def onPublishFeedbackStreamToggled(self, checked):
+    if checked:
+      try:
+        self.feedbackPublisher.start(self.feedbackStreamAddressTextbox.text.strip())
+      except (IOError, OSError, ValueError) as error:
+        print("Error: Feedback stream could not be started: ", error)
+        self.publishFeedbackStreamButton.checked = False
+        return
+      print("Publishing feedback stream on: ", self.feedbackPublisher.address)
+    else:
+      self.feedbackPublisher.stop()
+    self.feedbackStreamAddressTextbox.setReadOnly(self.feedbackPublisher.isRunning())
+    self.saveSession()
+    
+  def cleanup(self):
+    if self.sessionSaveTimer.isActive():
+      self.sessionSaveTimer.stop()
+      self.writeLastSession()
+    self.observeTargetPointNode(None)
+    self.removeConnectorObservers()
+    self.instructionStatusTimer.stop()
+    self.feedbackPublisher.stop()
+    self.profilingButton.checked = False
+    self.profilingShortcut.setParent(None)
+    
+  # ----- Functions to profile the module ------
+  
+  def onProfilingShortcutActivated(self):
+    self.profilingButton.checked = not self.profilingButton.checked
+    
+  def onProfilingWindowElapsed(self):
+    self.profilingButton.checked = False
+    
+  def onProfilingButtonToggled(self, checked):
+    if checked:
+      self.profiler.topCount = self.profilingTopCountSpinBox.value
+      self.profiler.start()
+      self.profilingTimer.start(int(self.profilingWindowSpinBox.value * 1000))
+      self.profilingButton.text = "Stop profiling"
+      print("Profiling started for", self.profilingWindowSpinBox.value, "s")
+      return
+    self.profilingTimer.stop()
+    self.profilingButton.text = "Start profiling"
+    if self.profiler.isActive():
+      try:
+        summaryPath = self.profiler.stop()
+      except (IOError, OSError) as error:
+        print("Error: Profiling results could not be written: ", error)
+        return
+      self.profilingOutputLabel.setText(summaryPath)
+      print("Profiling summary written to: ", summaryPath)
+    
+  # ----- Functions to save and restore session profiles ------
+  
+  def sessionState(self):
+    target = self.currentTargetPoint()
+    return {
+      "port": self.snrPortTextbox.text,
+      "hostname": self.snrHostnameTextbox.text,
+      "connected": self.IGTActive,
+      "target": None if target is None else target.tolist(),
+      "robotZeroed": self.robotZeroed,
+      "sendTargetPointEnabled": bool(self.sendTargetPointButton.enabled),
+      "sendSkinEntryPointEnabled": bool(self.sendSkinEntryPointButton.enabled),
+      "plannedPath": self.plannedPathComboBox.currentIndex if len(self.plannedPaths) > 0 else -1,
+      "feedbackStreamAddress": self.feedbackStreamAddressTextbox.text,
+      "feedbackStreamPublished": self.feedbackPublisher.isRunning(),
+      }
+      
+  def currentProfileName(self):
+    return self.profileComboBox.currentText.strip() or "default"
+    
+  def saveSession(self):
+    # Session changes are saved in the last session, except while a session is being restored
+    if self.restoringSession:
+      return
+    self.sessionSaveTimer.start()
+    
+  def writeLastSession(self):
+    try:
+      self.profileStore.saveLastSession(self.sessionState())
+    except (IOError, OSError) as error:
+      print("Error: Last session could not be saved: ", error)
+      
+  def onSaveProfileButtonClicked(self):
+    profileName = self.currentProfileName()
+    try:
+      self.profileStore.saveProfile(profileName, self.sessionState())
+    except (IOError, OSError) as error:
+      print("Error: Session profile could not be saved: ", error)
+      return
+    if self.profileComboBox.findText(profileName) < 0:
+      self.profileComboBox.addItem(profileName)
+    self.profileComboBox.setCurrentIndex(self.profileComboBox.findText(profileName))
+    print("Session profile saved: ", profileName)
+    
+  def onRestoreProfileButtonClicked(self):
+    profileName = self.currentProfileName()
+    state = self.profileStore.profile(profileName)
+    if state is None:
+      print("Error: No saved session profile named: ", profileName)
+      return
+    print("Restoring session profile: ", profileName)
+    self.restoreSession(state)
+    
+  def restoreLastSession(self):
+    if self.profileStore.lastSession is not None:
+      print("Restoring last session")
+      self.restoreSession(self.profileStore.lastSession)
+    
+  def restoreSession(self, state):
+    self.restoringSession = True
+    try:
+      if not self.IGTActive:
+        self.snrPortTextbox.setText(state.get("port", self.snrPortTextbox.text))
+        self.snrHostnameTextbox.setText(state.get("hostname", self.snrHostnameTextbox.text))
+      if state.get("target") is not None:
+        self.restoreTargetPoint(state["target"])
+      reconnected = False
+      if state.get("connected", False) and not self.IGTActive:
+        self.onCreateServerButtonClicked()
+        # IGTActive is only set when the server started
+        reconnected = self.IGTActive
+      # The robot zero state and send buttons only apply to the connection they were saved with
+      if reconnected:
+        self.robotZeroed = state.get("robotZeroed", False)
+        self.sendTargetPointButton.enabled = state.get("sendTargetPointEnabled", False)
+        self.sendSkinEntryPointButton.enabled = state.get("sendSkinEntryPointEnabled", False)
+      elif not self.IGTActive:
+        self.robotZeroed = False
+        self.sendTargetPointButton.enabled = False
+        self.sendSkinEntryPointButton.enabled = False
+      if not self.feedbackPublisher.isRunning():
+        self.feedbackStreamAddressTextbox.setText(state.get("feedbackStreamAddress", self.feedbackStreamAddressTextbox.text))
+        self.publishFeedbackStreamButton.checked = state.get("feedbackStreamPublished", False)
+      plannedPath = state.get("plannedPath", -1)
+      if state.get("target") is not None and plannedPath >= 0:
+        self.planSkinEntryPoints()
+        if plannedPath < len(self.plannedPaths):
+          self.plannedPathComboBox.setCurrentIndex(plannedPath)
+    finally:
+      self.restoringSession = False
+    self.saveSession()
+    
+  def restoreTargetPoint(self, target):
+    targetPointNode = self.targetPointNodeSelector.currentNode()
+    if targetPointNode is None:
+      targetPointNode = slicer.mrmlScene.GetFirstNodeByName("TARGET_POINT")
+      if targetPointNode is None:
+        targetPointNode = slicer.mrmlScene.AddNewNodeByClass("vtkMRMLMarkupsFiducialNode", "TARGET_POINT")
+        targetPointNode.CreateDefaultDisplayNodes()
+      self.targetPointNodeSelector.setCurrentNode(targetPointNode)
+    if targetPointNode.GetNumberOfControlPoints() == 0:
+      targetPointNode.AddControlPoint(vtk.vtkVector3d(target[0], target[1], target[2]))
+    else:
+      targetPointNode.SetNthControlPointPosition(0, target[0], target[1], target[2])
+    self.onTargetPointFiducialChanged()
   
   #def onIniButtonClicked(self):
     #ReceivedNeedleShape0 = slicer.mrmlScene.GetFirstNodeByName("currentshape_0")
@@ -465,16 +929,51 @@ class SensorizedNeedleModuleWidget(ScriptedLoadableModuleWidget):
     
   # ----- Functions to set target and skin entry points ------	  
     
+  def onTargetPointUpdateFinished(self):
+    self.onTargetPointFiducialChanged()
+    self.saveSession()
+    
   def onTargetPointFiducialChanged(self):
     targetPointNode = self.targetPointNodeSelector.currentNode()
+    self.observeTargetPointNode(targetPointNode)
     if targetPointNode is not None:
-    	if not targetPointNode.GetNumberOfControlPoints() == 0:
-    		targetCoordinatesRAS = targetPointNode.GetNthControlPointPositionVector(0)
-    		self.xTargetTextbox.setText(round(targetCoordinatesRAS[0],2))
-    		self.yTargetTextbox.setText(round(targetCoordinatesRAS[1],2))
-    		self.zTargetTextbox.setText(round(targetCoordinatesRAS[2],2))
-    		self.xSkinEntryTextbox.setText(self.xTargetTextbox.text)
-    		self.zSkinEntryTextbox.setText(self.zTargetTextbox.text)
+      if not targetPointNode.GetNumberOfControlPoints() == 0:
+        targetCoordinatesRAS = targetPointNode.GetNthControlPointPositionVector(0)
+        self.xTargetTextbox.setText(round(targetCoordinatesRAS[0],2))
+        self.yTargetTextbox.setText(round(targetCoordinatesRAS[1],2))
+        self.zTargetTextbox.setText(round(targetCoordinatesRAS[2],2))
+        self.updateTargetReachability(targetCoordinatesRAS)
+        
+  def observeTargetPointNode(self, targetPointNode):
+    # Follow control point moves so that the reachability is updated while the fiducial is dragged
+    if targetPointNode is self.observedTargetPointNode:
+      return
+    if self.observedTargetPointNode is not None:
+      self.observedTargetPointNode.RemoveObserver(self.targetPointObserverTag)
+      self.targetPointObserverTag = None
+    self.observedTargetPointNode = targetPointNode
+    if targetPointNode is not None:
+      self.targetPointObserverTag = targetPointNode.AddObserver(slicer.vtkMRMLMarkupsNode.PointModifiedEvent, self.profiler.wrap(self.onTargetPointModified))
+      
+  def onTargetPointModified(self, unusedArg1=None, unusedArg2=None):
+    self.onTargetPointFiducialChanged()
+    
+  def updateTargetReachability(self, targetCoordinatesRAS):
+    x, y, z = targetCoordinatesRAS[0], targetCoordinatesRAS[1], targetCoordinatesRAS[2]
+    entryReachable, xEntry, zEntry = self.workspaceMap.nearestReachableEntry(x, z)
+    depthReachable = self.workspaceMap.isDepthReachable(y)
+    # Skin entry stays aligned with the target; the nearest reachable entry is only reported
+    self.xSkinEntryTextbox.setText(self.xTargetTextbox.text)
+    self.zSkinEntryTextbox.setText(self.zTargetTextbox.text)
+    if entryReachable and depthReachable:
+      self.reachabilityLabel.setText("Target reachable")
+      self.reachabilityLabel.setStyleSheet('color: green')
+    elif entryReachable:
+      self.reachabilityLabel.setText("Target out of insertion depth range")
+      self.reachabilityLabel.setStyleSheet('color: red')
+    else:
+      self.reachabilityLabel.setText("Target out of workspace, nearest entry x: " + str(round(xEntry,2)) + " z: " + str(round(zEntry,2)))
+      self.reachabilityLabel.setStyleSheet('color: red')
     		
   #def onSkinEntryPointFiducialChanged(self):
     #skinEntryPointNode = self.skinEntryPointNodeSelector.currentNode()
@@ -520,52 +1019,133 @@ class SensorizedNeedleModuleWidget(ScriptedLoadableModuleWidget):
         #self.targetTableWidget.setItem(i , j, qt.QTableWidgetItem(str(round(targetTransformMatrix.GetElement(i,j),2))))
         
   def AddPointerModel(self, pointerNodeName):   
-    self.cyl = vtk.vtkCylinderSource()
-    self.cyl.SetRadius(1.5)
-    self.cyl.SetResolution(50)
-    self.cyl.SetHeight(100)
+    # The needle geometry is built once and shared by all pointer models
+    if self.pointerPolyData is None:
+      self.cyl = vtk.vtkCylinderSource()
+      self.cyl.SetRadius(1.5)
+      self.cyl.SetResolution(50)
+      self.cyl.SetHeight(100)
+      self.cyl.Update()
 
-    mapper = vtk.vtkPolyDataMapper()
-    mapper.SetInputConnection(self.cyl.GetOutputPort())
+      #Rotate cylinder
+      transformFilter = vtk.vtkTransformPolyDataFilter()
+      transform = vtk.vtkTransform()
+      transform.RotateX(90.0)
+      transform.Translate(0.0, -50.0, 0.0)
+      transform.Update()
+      transformFilter.SetInputConnection(self.cyl.GetOutputPort())
+      transformFilter.SetTransform(transform)
 
-    actor = vtk.vtkActor()
-    actor.SetOrientation(0,180,0)
-    actor.SetMapper(mapper)
+      self.sphere = vtk.vtkSphereSource()
+      self.sphere.SetRadius(3.0)
+      self.sphere.SetCenter(0, 0, 0)
+
+      self.pointerAppend = vtk.vtkAppendPolyData()
+      self.pointerAppend.AddInputConnection(self.sphere.GetOutputPort())
+      self.pointerAppend.AddInputConnection(transformFilter.GetOutputPort())
+      self.pointerAppend.Update()
+      self.pointerPolyData = self.pointerAppend.GetOutput()
 
-    node = self.cyl.GetOutput()
     locatorModelNode = slicer.mrmlScene.AddNewNodeByClass("vtkMRMLModelNode", pointerNodeName)
-    locatorModelNode.SetAndObservePolyData(node)
+    locatorModelNode.SetAndObservePolyData(self.pointerPolyData)
     locatorModelNode.CreateDefaultDisplayNodes()
     locatorModelNode.SetDisplayVisibility(True)
     # Set needle model color based on the type of needle (planned target, reachable target, or current position)
-    if pointerNodeName == "PlannedPathNeedle": 
+    if pointerNodeName.startswith("PlannedPathNeedle"): 
       locatorModelNode.GetDisplayNode().SetColor(0.80,0.80,0.80) # grey
     elif pointerNodeName == "ShapeNeedle":
       locatorModelNode.GetDisplayNode().SetColor(0.48,0.75,0.40) # green
     #else: #pointerNodeName == "CurrentPositionNeedle"
      # locatorModelNode.GetDisplayNode().SetColor(0.40,0.48,0.75) # blue
-    self.cyl.Update()
-
-    #Rotate cylinder
-    transformFilter = vtk.vtkTransformPolyDataFilter()
-    transform = vtk.vtkTransform()
-    transform.RotateX(90.0)
-    transform.Translate(0.0, -50.0, 0.0)
-    transform.Update()
-    transformFilter.SetInputConnection(self.cyl.GetOutputPort())
-    transformFilter.SetTransform(transform)
-
-    self.sphere = vtk.vtkSphereSource()
-    self.sphere.SetRadius(3.0)
-    self.sphere.SetCenter(0, 0, 0)
-
-    self.append = vtk.vtkAppendPolyData()
-    self.append.AddInputConnection(self.sphere.GetOutputPort())
-    self.append.AddInputConnection(transformFilter.GetOutputPort())
-    self.append.Update()
-
-    locatorModelNode.SetAndObservePolyData(self.append.GetOutput())
     #self.treeView.setMRMLScene(slicer.mrmlScene)
+    
+  # ----- Functions to plan skin entry points ------
+  
+  def currentTargetPoint(self):
+    targetPointNode = self.targetPointNodeSelector.currentNode()
+    if targetPointNode is None or targetPointNode.GetNumberOfControlPoints() == 0:
+      return None
+    targetCoordinatesRAS = targetPointNode.GetNthControlPointPositionVector(0)
+    return np.array([targetCoordinatesRAS[0], targetCoordinatesRAS[1], targetCoordinatesRAS[2]])
+    
+  def onPlanButtonClicked(self):
+    self.planSkinEntryPoints()
+    
+  def planSkinEntryPoints(self):
+    self.plannedTarget = self.currentTargetPoint()
+    self.plannedPaths = self.trajectoryPlanner.plan(self.plannedTarget, PLANNED_PATH_COUNT)
+    print("Planned", len(self.plannedPaths), "reachable skin entry points")
+    
+    self.plannedPathComboBox.blockSignals(True)
+    self.plannedPathComboBox.clear()
+    for path in self.plannedPaths:
+      self.plannedPathComboBox.addItem("x: " + str(round(path['entry'][0],2)) + " z: " + str(round(path['entry'][2],2))
+                                       + " (" + str(path['angles'][0]) + "°, " + str(path['angles'][1]) + "°)"
+                                       + " length: " + str(round(path['pathLength'],1)) + " mm")
+    self.plannedPathComboBox.blockSignals(False)
+    
+    self.updatePlannedPathModels()
+    if len(self.plannedPaths) > 0:
+      self.plannedPathComboBox.setCurrentIndex(0)
+      self.onPlannedPathSelected(0)
+    else:
+      self.clearShapeDeviation()
+      print("Error: No reachable skin entry point for the target point")
+      
+  def plannedPathNodeName(self, baseName, rank):
+    return baseName if rank == 0 else baseName + "_" + str(rank + 1)
+    
+  def updatePlannedPathModels(self):
+    # Models and transforms are reused between plans, only their matrices change
+    for rank in range(PLANNED_PATH_COUNT):
+      modelNode = slicer.mrmlScene.GetFirstNodeByName(self.plannedPathNodeName("PlannedPathNeedle", rank))
+      if rank >= len(self.plannedPaths):
+        if modelNode is not None:
+          modelNode.SetDisplayVisibility(False)
+        continue
+      if modelNode is None:
+        self.AddPointerModel(self.plannedPathNodeName("PlannedPathNeedle", rank))
+        modelNode = slicer.mrmlScene.GetFirstNodeByName(self.plannedPathNodeName("PlannedPathNeedle", rank))
+      transformNode = slicer.mrmlScene.GetFirstNodeByName(self.plannedPathNodeName("PlannedPathTransform", rank))
+      if transformNode is None:
+        transformNode = slicer.vtkMRMLLinearTransformNode()
+        transformNode.SetName(self.plannedPathNodeName("PlannedPathTransform", rank))
+        slicer.mrmlScene.AddNode(transformNode)
+      if rank == 0:
+        self.PlannedPathTransform = transformNode
+      transformNode.SetMatrixTransformToParent(self.plannedPathMatrix(self.plannedPaths[rank]['entry'], self.plannedTarget))
+      modelNode.SetAndObserveTransformNodeID(transformNode.GetID())
+      modelNode.SetDisplayVisibility(True)
+      
+  def plannedPathMatrix(self, entry, target):
+    # The pointer model tip is at its origin and its shaft along -z: align +z with the insertion direction
+    direction = (target - entry) / np.linalg.norm(target - entry)
+    helper = np.array([1.0, 0.0, 0.0]) if abs(direction[0]) < 0.9 else np.array([0.0, 1.0, 0.0])
+    xAxis = np.cross(helper, direction)
+    xAxis /= np.linalg.norm(xAxis)
+    yAxis = np.cross(direction, xAxis)
+    plannedPathMatrix = vtk.vtkMatrix4x4()
+    plannedPathMatrix.Identity()
+    for row in range(3):
+      plannedPathMatrix.SetElement(row, 0, xAxis[row])
+      plannedPathMatrix.SetElement(row, 1, yAxis[row])
+      plannedPathMatrix.SetElement(row, 2, direction[row])
+      plannedPathMatrix.SetElement(row, 3, target[row])
+    return plannedPathMatrix
+    
+  def onPlannedPathSelected(self, index):
+    if index < 0 or index >= len(self.plannedPaths):
+      return
+    entry = self.plannedPaths[index]['entry']
+    self.shapeDeviation.setPlannedPath(entry, self.plannedTarget)
+    self.xSkinEntryTextbox.setText(round(entry[0],2))
+    self.ySkinEntryTextbox.setText(round(entry[1],2))
+    self.zSkinEntryTextbox.setText(round(entry[2],2))
+    # Highlight the selected path
+    for rank in range(len(self.plannedPaths)):
+      modelNode = slicer.mrmlScene.GetFirstNodeByName(self.plannedPathNodeName("PlannedPathNeedle", rank))
+      if modelNode is not None:
+        modelNode.GetDisplayNode().SetOpacity(1.0 if rank == index else 0.3)
   		
     		
   def onPlannedPathNeedleVisibleButtonClicked(self):
@@ -650,6 +1230,8 @@ class SensorizedNeedleModuleWidget(ScriptedLoadableModuleWidget):
     self.openIGTNode.PushNode(zeroNode)
     self.sendSkinEntryPointButton.enabled = True
     self.sendTargetPointButton.enabled = True
+    self.robotZeroed = True
+    self.saveSession()
     
   def onsendTargetPointButtonClicked(self):   
     print("Sending target point coordinates")
@@ -663,13 +1245,64 @@ class SensorizedNeedleModuleWidget(ScriptedLoadableModuleWidget):
 
   def onsendSkinEntryPointButtonClicked(self):  
     print("Sending skin entry point coordinates")
-    #skinEntryMsgNode = slicer.mrmlScene.GetFirstNodeByName("SKIN_ENTRY_POINT")
-    skinEntryMsgNode = slicer.mrmlScene.GetFirstNodeByName("TARGET_POINT")
+    target = self.currentTargetPoint()
+    if self.plannedTarget is None or target is None or not np.array_equal(target, self.plannedTarget):
+      # Never send an entry point the user has not reviewed: show the new plan and wait for a new send
+      self.planSkinEntryPoints()
+      print("Error: Target point changed since the last plan, review the planned path and send again")
+      return
+    selectedPath = self.plannedPathComboBox.currentIndex
+    if selectedPath < 0 or selectedPath >= len(self.plannedPaths):
+      print("Error: No reachable skin entry point to send")
+      return
+    entry = self.plannedPaths[selectedPath]['entry']
+    # Single SKIN_ENTRY_POINT node updated in place and sent with one push
+    skinEntryMsgNode = slicer.mrmlScene.GetFirstNodeByName("SKIN_ENTRY_POINT")
+    if skinEntryMsgNode is None:
+      skinEntryMsgNode = slicer.vtkMRMLMarkupsFiducialNode()
+      skinEntryMsgNode.SetName("SKIN_ENTRY_POINT")
+      slicer.mrmlScene.AddNode(skinEntryMsgNode)
+    if skinEntryMsgNode.GetNumberOfControlPoints() == 0:
+      skinEntryMsgNode.AddControlPoint(vtk.vtkVector3d(entry[0], entry[1], entry[2]))
+    else:
+      skinEntryMsgNode.SetNthControlPointPosition(0, entry[0], entry[1], entry[2])
+    print("Sending skin entry point: ", entry)
     self.openIGTNode.RegisterOutgoingMRMLNode(skinEntryMsgNode)
     self.openIGTNode.PushNode(skinEntryMsgNode)  
-   #TODO Make it aligned with target point and not a point you can click 
-   # Maybe define one that is linea, one with 5 degrees angle to the right, one with five degree angle to the left 
+    self.saveSession()
+   
+   # ----- Functions to get trajectory estimation model instructions ------
    
+  def onInstructionNodeModified(self, unusedArg1=None, unusedArg2=None):
+    ReceivedInstruction = slicer.mrmlScene.GetFirstNodeByName("/estimation/instruction")
+    try:
+      self.instructionFeed.update(ReceivedInstruction.GetText())
+    except ValueError as error:
+      print("Error: Invalid instruction received: ", error)
+      return
+    # Messages without a text instruction are summarized from dz and dθ
+    instruction = self.instructionFeed.instruction or ("dz: %.2f, dθ: %.2f" % (self.instructionFeed.dz, self.instructionFeed.dtheta))
+    self.textboxBinding.setValue("instruction", instruction)
+    self.textboxBinding.setValue("dz", self.instructionFeed.dz)
+    self.textboxBinding.setValue("dtheta", self.instructionFeed.dtheta)
+    if not self.instructionStatusTimer.isActive():
+      self.instructionStatusTimer.start()
+    self.updateInstructionStatus()
+    
+  def updateInstructionStatus(self):
+    if not self.instructionFeed.hasInstruction():
+      return
+    lag = self.instructionFeed.lag()
+    now = time.monotonic()
+    self.textboxBinding.setValue("instructionAge", self.instructionFeed.age(now))
+    self.textboxBinding.setValue("instructionRate", self.instructionFeed.rate(now))
+    self.textboxBinding.setValue("instructionLag", "-" if lag is None else lag)
+    # Flag the instruction while the model lags behind the newest shape
+    lagging = lag is not None and lag > self.maxInstructionLagSpinBox.value
+    if lagging != self.instructionLagging:
+      self.instructionLagging = lagging
+      self.instructionTextbox.setStyleSheet('QLineEdit { background-color: rgb(255,170,170) }' if lagging else '')
+      
    # ----- Functions to get needle pose feedback ------
      
   def onNeedlePoseNodeModified(poseNode, unusedArg2=None, unusedArg3=None):
@@ -699,12 +1332,22 @@ class SensorizedNeedleModuleWidget(ScriptedLoadableModuleWidget):
       rest_string = rest_string[idx +1 :len(rest_string)]
       theta = rest_string
       
-      poseNode.dzTextbox.setText(dz)
-      poseNode.dthetaTextbox.setText(dtheta)
-      poseNode.xTextbox.setText(x)
-      poseNode.yTextbox.setText(y)
-      poseNode.zTextbox.setText(z)
-      poseNode.thetaTextbox.setText(theta)
+      # dz and dθ come from the instruction topic once the estimation model publishes it
+      if not poseNode.instructionFeed.hasInstruction():
+        poseNode.textboxBinding.setValue("dz", dz)
+        poseNode.textboxBinding.setValue("dtheta", dtheta)
+      poseNode.textboxBinding.setValue("x", x)
+      poseNode.textboxBinding.setValue("y", y)
+      poseNode.textboxBinding.setValue("z", z)
+      poseNode.textboxBinding.setValue("theta", theta)
+      # Only complete numeric poses are published, the display and XStage update do not depend on it
+      if poseNode.feedbackPublisher.isRunning():
+        try:
+          poseValues = [float(value) for value in (dz, dtheta, x, y, z, theta)]
+        except ValueError:
+          print("Error: Needle pose not published, non-numeric field in: ", concatenatePose)
+        else:
+          poseNode.feedbackPublisher.publishPose(*poseValues)
       
       # Update the transform of Block X 
       XStageMatrix = vtk.vtkMatrix4x4()
@@ -740,20 +1383,22 @@ class SensorizedNeedleModuleWidget(ScriptedLoadableModuleWidget):
       nb_poses = concatenateShape[idx +1 :len(concatenateShape)]
       nb_poses = int(nb_poses)
       print("Needle shape nb:", nb_shape ,"was received and has", nb_poses,"poses") 
+      shapeNumber = None
+      if nb_shape.strip().isdigit():
+        shapeNumber = int(nb_shape)
+        shapeNode.instructionFeed.setLatestShapeNumber(shapeNumber)
+        shapeNode.updateInstructionStatus()
     
       # Initialize variables	
-      #i = 0;
-      pointPositions = np.empty((0, 3), float)
+      pointPositions = np.empty((nb_poses, 3), float)
+      transformMatrix_temp = vtk.vtkMatrix4x4()
     
-      #while  slicer.mrmlScene.GetFirstNodeByName("currentshape_" + str(i)) is not None:
       for i in range (nb_poses):
         ReceivedNeedleShape_temp = slicer.mrmlScene.GetFirstNodeByName("currentshape_" +  str(i))
-        transformMatrix_temp = vtk.vtkMatrix4x4()
         ReceivedNeedleShape_temp.GetMatrixTransformToParent(transformMatrix_temp)
-        i+=1
         
-        # Append new point to array point positions
-        pointPositions = np.append(pointPositions, np.array([[transformMatrix_temp.GetElement(0,3), transformMatrix_temp.GetElement(1,3), transformMatrix_temp.GetElement(2,3)]]), axis=0)
+        # Store point position of pose i
+        pointPositions[i] = [transformMatrix_temp.GetElement(0,3), transformMatrix_temp.GetElement(1,3), transformMatrix_temp.GetElement(2,3)]
 
       # For list of fiducials  
         #pointsVector = vtk.vtkVector3d()
@@ -761,34 +1406,103 @@ class SensorizedNeedleModuleWidget(ScriptedLoadableModuleWidget):
         #pointsVector.SetY(transformMatrix_temp.GetElement(1,3))
         #pointsVector.SetZ(transformMatrix_temp.GetElement(2,3))
         #FiducialsNeedleShapeNode.AddControlPoint(pointsVector)
-      # Display the end point transform 
-      ReceivedNeedleShape_END = slicer.mrmlScene.GetFirstNodeByName("currentshape_" +  str(nb_poses-1))
-      endPointtransformMatrix = vtk.vtkMatrix4x4()
-      ReceivedNeedleShape_END.GetMatrixTransformToParent(endPointtransformMatrix)
-    
-      shapeNode.xNeedleEndTextbox.setText(round(endPointtransformMatrix.GetElement(0,3),2))
-      shapeNode.yNeedleEndTextbox.setText(round(endPointtransformMatrix.GetElement(1,3),2))
-      shapeNode.zNeedleEndTextbox.setText(round(endPointtransformMatrix.GetElement(2,3),2))
         
-      # Update Shape Needle Curve    
-      #print(pointPositions)
-      print("The nb of points in the Curve is:" , len(pointPositions))
-      points = vtk.vtkPoints()
-      vtkpointsData = vtk.util.numpy_support.numpy_to_vtk(pointPositions, deep=1)
-      points.SetNumberOfPoints(len(pointPositions))
-      points.SetData(vtkpointsData)
-    
+      # Smooth the shape, reject outliers and skip changes below the display tolerance
+      filteredPositions = shapeNode.shapeFilter.apply(pointPositions)
+      if filteredPositions is None:
+        return
+        
+      # Display the end point
+      shapeNode.textboxBinding.setValue("xNeedleEnd", filteredPositions[-1,0])
+      shapeNode.textboxBinding.setValue("yNeedleEnd", filteredPositions[-1,1])
+      shapeNode.textboxBinding.setValue("zNeedleEnd", filteredPositions[-1,2])
+        
+      # Update Shape Needle Curve, the curve node is reused between shapes
+      print("The nb of points in the Curve is:" , len(filteredPositions))
       CurveNeedleShapeNode = slicer.mrmlScene.GetFirstNodeByName("CurveNeedleShape") 
-      slicer.mrmlScene.RemoveNode(CurveNeedleShapeNode)
-      CurveNeedleShapeNode = slicer.vtkMRMLMarkupsCurveNode()
-      CurveNeedleShapeNode.SetName("CurveNeedleShape")
-      slicer.mrmlScene.AddNode(CurveNeedleShapeNode) 
-      CurveNeedleShapeNode.SetControlPointPositionsWorld(points)      
-    
-      slicer.util.updateMarkupsControlPointsFromArray(CurveNeedleShapeNode, pointPositions)
+      if CurveNeedleShapeNode is None:
+        CurveNeedleShapeNode = slicer.vtkMRMLMarkupsCurveNode()
+        CurveNeedleShapeNode.SetName("CurveNeedleShape")
+        slicer.mrmlScene.AddNode(CurveNeedleShapeNode) 
+      slicer.util.updateMarkupsControlPointsFromArray(CurveNeedleShapeNode, filteredPositions)
+      shapeNode.updateShapeDeviation(filteredPositions)
+      shapeNode.feedbackPublisher.publishShape(filteredPositions, shapeNumber)
     else: 
       print("Error: No indication on nb of needle shape poses sent")    
     
+  def onShapeFilterParameterChanged(self, unusedArg=None):
+    self.shapeFilter.temporalMode = ["none", "ema", "kalman"][self.temporalFilterComboBox.currentIndex]
+    self.shapeFilter.emaAlpha = self.emaAlphaSpinBox.value
+    self.shapeFilter.splineFit = self.splineFitCheckBox.checked
+    self.shapeFilter.maxPoseCountJump = self.maxPoseCountJumpSpinBox.value
+    self.shapeFilter.maxPointJump = self.maxPointJumpSpinBox.value
+    self.shapeFilter.displayTolerance = self.displayToleranceSpinBox.value
+    self.shapeFilter.reset()
+    
+  def updateShapeDeviation(self, pointPositions):
+    if not self.shapeDeviation.hasPlannedPath() or len(pointPositions) < 2:
+      return
+    deviation = self.shapeDeviation.update(pointPositions)
+    self.textboxBinding.setValue("maxDeviation", deviation.max())
+    
+    deviationModelNode = slicer.mrmlScene.GetFirstNodeByName("NeedleShapeDeviation")
+    if self.deviationPolyData is None or deviationModelNode is None:
+      self.AddShapeDeviationModel("NeedleShapeDeviation")
+    elif not deviationModelNode.GetDisplayVisibility():
+      deviationModelNode.SetDisplayVisibility(True)
+    nbPoints = len(deviation)
+    if nbPoints != self.deviationPointCount or self.shapeDeviation.bufferVersion != self.deviationBufferVersion:
+      # Wrap the deviation engine buffers without copy, only when their size changes
+      points = vtk.vtkPoints()
+      points.SetData(vtk.util.numpy_support.numpy_to_vtk(self.shapeDeviation.points[:nbPoints], deep=0))
+      scalars = vtk.util.numpy_support.numpy_to_vtk(deviation, deep=0)
+      scalars.SetName("Deviation")
+      # Single polyline through all the points
+      lineIds = np.concatenate(([nbPoints], np.arange(nbPoints))).astype(vtk.util.numpy_support.ID_TYPE_CODE)
+      lines = vtk.vtkCellArray()
+      lines.SetCells(1, vtk.util.numpy_support.numpy_to_vtkIdTypeArray(lineIds, deep=1))
+      self.deviationPolyData.SetPoints(points)
+      self.deviationPolyData.SetLines(lines)
+      self.deviationPolyData.GetPointData().SetScalars(scalars)
+      self.deviationPointCount = nbPoints
+      self.deviationBufferVersion = self.shapeDeviation.bufferVersion
+    else:
+      # Same buffers updated in place by the deviation engine
+      self.deviationPolyData.GetPoints().GetData().Modified()
+      self.deviationPolyData.GetPoints().Modified()
+      self.deviationPolyData.GetPointData().GetScalars().Modified()
+    self.deviationPolyData.Modified()
+    
+  def clearShapeDeviation(self):
+    # No planned path to compare the shape with: hide the previous deviation instead of leaving it stale
+    self.shapeDeviation.clearPlannedPath()
+    self.textboxBinding.setValue("maxDeviation", "No planned path selected")
+    deviationModelNode = slicer.mrmlScene.GetFirstNodeByName("NeedleShapeDeviation")
+    if deviationModelNode is not None:
+      deviationModelNode.SetDisplayVisibility(False)
+    
+  def AddShapeDeviationModel(self, deviationNodeName):
+    self.deviationPolyData = vtk.vtkPolyData()
+    self.deviationPointCount = 0
+    self.deviationTube = vtk.vtkTubeFilter()
+    self.deviationTube.SetInputData(self.deviationPolyData)
+    self.deviationTube.SetRadius(1.0)
+    self.deviationTube.SetNumberOfSides(12)
+    
+    deviationModelNode = slicer.mrmlScene.GetFirstNodeByName(deviationNodeName)
+    if deviationModelNode is None:
+      deviationModelNode = slicer.mrmlScene.AddNewNodeByClass("vtkMRMLModelNode", deviationNodeName)
+      deviationModelNode.CreateDefaultDisplayNodes()
+    deviationModelNode.SetPolyDataConnection(self.deviationTube.GetOutputPort())
+    # Color the tube by the per-point deviation scalars
+    displayNode = deviationModelNode.GetDisplayNode()
+    displayNode.SetActiveScalarName("Deviation")
+    displayNode.SetAndObserveColorNodeID("vtkMRMLColorTableNodeFileColdToHotRainbow.txt")
+    displayNode.SetScalarRangeFlag(slicer.vtkMRMLDisplayNode.UseManualScalarRange)
+    displayNode.SetScalarRange(SHAPE_DEVIATION_SCALAR_RANGE[0], SHAPE_DEVIATION_SCALAR_RANGE[1])
+    displayNode.SetScalarVisibility(True)
+    deviationModelNode.SetDisplayVisibility(True)
+    
   def AddBlockModel(self, blockNodeName):   
     self.Xrec = vtk.vtkCubeSource()
     self.Xrec.SetXLength(60)
@@ -849,16 +1563,907 @@ class SensorizedNeedleModuleWidget(ScriptedLoadableModuleWidget):
     self.append.Update()
 
     locatorModelNode.SetAndObservePolyData(self.append.GetOutput())
-    #self.treeView.setMRMLScene(slicer.mrmlScene)  
-    
-    
-    
-    
-    
-    
-    
-    
-    
-    
-    
-  
+    #self.treeView.setMRMLScene(slicer.mrmlScene)
+
+
+class NeedleGuideWorkspaceMap(object):
+  """Precomputed reachability map of the needle guide workspace.
+
+  The x/z stage plane is sampled on a regular grid that extends past the stage limits.
+  Each cell stores whether the stages can reach it and the flat index of the nearest
+  reachable cell, so a target is checked with a few scalar operations and array reads.
+  Insertion depth y is an independent axis and is checked as an interval. The needle
+  rotation θ does not move the needle tip, so it does not limit the reachable targets.
+  """
+
+  def __init__(self, xRange=NEEDLE_GUIDE_X_RANGE, zRange=NEEDLE_GUIDE_Z_RANGE,
+               depthRange=NEEDLE_GUIDE_DEPTH_RANGE,
+               resolution=1.0, margin=50.0):
+    self.xRange = (float(xRange[0]), float(xRange[1]))
+    self.zRange = (float(zRange[0]), float(zRange[1]))
+    self.depthRange = (float(depthRange[0]), float(depthRange[1]))
+    self.resolution = float(resolution)
+    self.invResolution = 1.0 / self.resolution
+    
+    # Grid sampling the stage limits plus a margin around them
+    self.xOrigin = self.xRange[0] - margin
+    self.zOrigin = self.zRange[0] - margin
+    self.nx = int(np.ceil((self.xRange[1] - self.xRange[0] + 2*margin) * self.invResolution)) + 1
+    self.nz = int(np.ceil((self.zRange[1] - self.zRange[0] + 2*margin) * self.invResolution)) + 1
+    self.xCells = self.xOrigin + self.resolution * np.arange(self.nx)
+    self.zCells = self.zOrigin + self.resolution * np.arange(self.nz)
+    
+    X, Z = np.meshgrid(self.xCells, self.zCells, indexing='ij')
+    self.reachable = self.computeReachable(X, Z)
+    self.nearestIndex = self.computeNearestIndex()
+    
+  def computeReachable(self, X, Z):
+    # Rectangular stage travel; restrict this mask for fixtures or keep-out zones
+    return (X >= self.xRange[0]) & (X <= self.xRange[1]) & (Z >= self.zRange[0]) & (Z <= self.zRange[1])
+    
+  def computeNearestIndex(self):
+    reachable = self.reachable
+    nearestIndex = np.arange(reachable.size, dtype=np.int32).reshape(reachable.shape)
+    if not reachable.any():
+      return nearestIndex
+    # The nearest reachable cell of an unreachable cell always lies on the border of the reachable region
+    padded = np.pad(reachable, 1, mode='constant', constant_values=False)
+    interior = padded[:-2,1:-1] & padded[2:,1:-1] & padded[1:-1,:-2] & padded[1:-1,2:]
+    borderI, borderK = np.nonzero(reachable & ~interior)
+    borderIndex = np.ravel_multi_index((borderI, borderK), reachable.shape).astype(np.int32)
+    unreachableI, unreachableK = np.nonzero(~reachable)
+    # Process unreachable cells in chunks to bound the size of the distance matrix
+    chunkSize = 4096
+    for start in range(0, len(unreachableI), chunkSize):
+      i = unreachableI[start:start+chunkSize]
+      k = unreachableK[start:start+chunkSize]
+      distances = (i[:,None] - borderI[None,:])**2 + (k[:,None] - borderK[None,:])**2
+      nearestIndex[i, k] = borderIndex[np.argmin(distances, axis=1)]
+    return nearestIndex
+    
+  def cellIndex(self, x, z):
+    i = int((x - self.xOrigin) * self.invResolution + 0.5)
+    k = int((z - self.zOrigin) * self.invResolution + 0.5)
+    i = 0 if i < 0 else (self.nx - 1 if i >= self.nx else i)
+    k = 0 if k < 0 else (self.nz - 1 if k >= self.nz else k)
+    return i, k
+    
+  def isEntryReachable(self, x, z):
+    if x < self.xRange[0] or x > self.xRange[1] or z < self.zRange[0] or z > self.zRange[1]:
+      return False
+    i, k = self.cellIndex(x, z)
+    return bool(self.reachable[i, k])
+    
+  def isEntryReachableArray(self, x, z):
+    x = np.asarray(x, dtype=float)
+    z = np.asarray(z, dtype=float)
+    i = np.clip(((x - self.xOrigin) * self.invResolution + 0.5).astype(np.intp), 0, self.nx - 1)
+    k = np.clip(((z - self.zOrigin) * self.invResolution + 0.5).astype(np.intp), 0, self.nz - 1)
+    inside = (x >= self.xRange[0]) & (x <= self.xRange[1]) & (z >= self.zRange[0]) & (z <= self.zRange[1])
+    return inside & self.reachable[i, k]
+    
+  def entryClearanceArray(self, x, z):
+    # Distance to the closest stage limit; negative outside the stage travel
+    x = np.asarray(x, dtype=float)
+    z = np.asarray(z, dtype=float)
+    return np.minimum(np.minimum(x - self.xRange[0], self.xRange[1] - x),
+                      np.minimum(z - self.zRange[0], self.zRange[1] - z))
+    
+  def isDepthReachable(self, y):
+    return self.depthRange[0] <= y <= self.depthRange[1]
+    
+  def nearestReachableEntry(self, x, z):
+    """Return (reachable, xEntry, zEntry) with the closest stage position to (x, z)."""
+    if self.isEntryReachable(x, z):
+      return True, x, z
+    i, k = self.cellIndex(x, z)
+    nearest = int(self.nearestIndex[i, k])
+    if not self.reachable.flat[nearest]:
+      return False, x, z
+    ni, nk = divmod(nearest, self.nz)
+    # Project onto the nearest reachable cell, kept inside the stage limits
+    halfCell = 0.5 * self.resolution
+    xCell, zCell = self.xCells[ni], self.zCells[nk]
+    xEntry = min(max(x, xCell - halfCell, self.xRange[0]), xCell + halfCell, self.xRange[1])
+    zEntry = min(max(z, zCell - halfCell, self.zRange[0]), zCell + halfCell, self.zRange[1])
+    return False, float(xEntry), float(zEntry)
+
+
+class NeedleTrajectoryPlanner(object):
+  """Scores a batch of candidate skin entry points for a target in a single NumPy pass.
+
+  Candidates tilt the insertion axis y by every combination of the given angles in
+  the x-y and z-y planes. Each candidate enters the skin plane y = skinPlaneY and
+  ends at the target; it is scored on path length and lateral deviation from the
+  straight insertion, and unreachable candidates are discarded. Candidates with the
+  same score are ranked by their clearance from the stage limits, and a candidate
+  is followed by its mirror (opposite angles) when both tie, so a centred target
+  is offered the straight path and the symmetric tilts on either side.
+  """
+
+  pathType = np.dtype([('entry', float, (3,)), ('angles', float, (2,)),
+                       ('pathLength', float), ('deviation', float), ('score', float)])
+
+  def __init__(self, workspaceMap, angles=PLANNED_PATH_ANGLES, skinPlaneY=0.0,
+               lengthWeight=1.0, deviationWeight=2.0):
+    self.workspaceMap = workspaceMap
+    self.skinPlaneY = float(skinPlaneY)
+    self.lengthWeight = float(lengthWeight)
+    self.deviationWeight = float(deviationWeight)
+    
+    angleX, angleZ = np.meshgrid(np.asarray(angles, dtype=float), np.asarray(angles, dtype=float), indexing='ij')
+    self.angles = np.stack((angleX.ravel(), angleZ.ravel()), axis=1)
+    self.tanX = np.tan(np.radians(self.angles[:,0]))
+    self.tanZ = np.tan(np.radians(self.angles[:,1]))
+    # Path length and lateral entry offset per mm of insertion depth
+    self.lengthFactor = np.sqrt(1.0 + self.tanX**2 + self.tanZ**2)
+    self.offsetFactor = np.sqrt(self.tanX**2 + self.tanZ**2)
+    # Candidates sharing a key with their mirror are kept next to each other when tied
+    index = np.arange(len(self.angles))
+    mirrorIndex = np.abs(self.angles[:,None,:] + self.angles[None,:,:]).sum(axis=2).argmin(axis=1)
+    hasMirror = np.all(np.isclose(self.angles[mirrorIndex], -self.angles), axis=1)
+    self.mirrorKey = np.where(hasMirror, np.minimum(index, mirrorIndex), index)
+    
+  def plan(self, target, count=PLANNED_PATH_COUNT):
+    """Return up to `count` reachable candidates for `target`, best first."""
+    if target is None:
+      return np.empty(0, dtype=self.pathType)
+    depth = float(target[1]) - self.skinPlaneY
+    xEntry = float(target[0]) - depth * self.tanX
+    zEntry = float(target[2]) - depth * self.tanZ
+    pathLength = abs(depth) * self.lengthFactor
+    deviation = abs(depth) * self.offsetFactor
+    
+    reachable = self.workspaceMap.isEntryReachableArray(xEntry, zEntry)
+    reachable &= (pathLength >= self.workspaceMap.depthRange[0]) & (pathLength <= self.workspaceMap.depthRange[1])
+    reachable &= depth > 0
+    score = np.where(reachable, self.lengthWeight * pathLength + self.deviationWeight * deviation, np.inf)
+    clearance = self.workspaceMap.entryClearanceArray(xEntry, zEntry)
+    
+    # Mirrored angles only differ by rounding, so ties are resolved on rounded values
+    order = np.lexsort((self.mirrorKey, -np.round(clearance, 6), np.round(score, 6)))[:count]
+    order = order[np.isfinite(score[order])]
+    paths = np.empty(len(order), dtype=self.pathType)
+    paths['entry'] = np.stack((xEntry[order], np.full(len(order), self.skinPlaneY), zEntry[order]), axis=1)
+    paths['angles'] = self.angles[order]
+    paths['pathLength'] = pathLength[order]
+    paths['deviation'] = deviation[order]
+    paths['score'] = score[order]
+    return paths
+
+
+class NeedleShapeDeviation(object):
+  """Distance of each needle shape point to the planned insertion line.
+
+  The planned line is kept as an origin and a unit direction. Point and deviation
+  buffers are reused between shapes, and only the points that are new or moved by
+  more than `changeTolerance` since the previous shape are recomputed.
+  """
+
+  def __init__(self, capacity=256, changeTolerance=0.05):
+    self.origin = None
+    self.direction = None
+    self.changeTolerance = float(changeTolerance)
+    self.points = np.zeros((capacity, 3))
+    self.deviation = np.zeros(capacity)
+    self.count = 0
+    # Incremented when the buffers are reallocated, so that views on them can be refreshed
+    self.bufferVersion = 0
+    
+  def setPlannedPath(self, entry, target):
+    entry = np.asarray(entry, dtype=float)
+    direction = np.asarray(target, dtype=float) - entry
+    self.origin = entry
+    self.direction = direction / np.linalg.norm(direction)
+    self.count = 0
+    
+  def clearPlannedPath(self):
+    self.origin = None
+    self.direction = None
+    self.count = 0
+    
+  def hasPlannedPath(self):
+    return self.direction is not None
+    
+  def distanceToPlannedPath(self, points):
+    offset = points - self.origin
+    perpendicular = offset - np.outer(offset.dot(self.direction), self.direction)
+    return np.sqrt(np.einsum('ij,ij->i', perpendicular, perpendicular))
+    
+  def update(self, points):
+    """Return the deviation of every point of the new shape, as a view on the reused buffer."""
+    points = np.asarray(points, dtype=float)
+    nbPoints = len(points)
+    if nbPoints > len(self.points):
+      capacity = max(nbPoints, 2 * len(self.points))
+      grownPoints = np.zeros((capacity, 3))
+      grownPoints[:self.count] = self.points[:self.count]
+      grownDeviation = np.zeros(capacity)
+      grownDeviation[:self.count] = self.deviation[:self.count]
+      self.points, self.deviation = grownPoints, grownDeviation
+      self.bufferVersion += 1
+    
+    common = min(nbPoints, self.count)
+    moved = np.flatnonzero(np.abs(points[:common] - self.points[:common]).max(axis=1) > self.changeTolerance) if common else np.empty(0, dtype=np.intp)
+    indices = np.concatenate((moved, np.arange(common, nbPoints)))
+    if len(indices):
+      self.points[indices] = points[indices]
+      self.deviation[indices] = self.distanceToPlannedPath(points[indices])
+    self.count = nbPoints
+    return self.deviation[:nbPoints]
+
+
+class NeedleShapeFilter(object):
+  """Filter stage between the decoded needle shape poses and the display.
+
+  Shapes with a jump in their number of poses or point positions are rejected,
+  optionally fitted with a cubic B-spline along the needle, then smoothed over
+  time with an exponential moving average of all points or a Kalman filter on
+  the tip. The state lives in reused arrays and every step costs O(N) per shape.
+  `apply` returns None when the shape is rejected or moved less than the display
+  tolerance since the last displayed shape.
+  """
+
+  def __init__(self, temporalMode="none", emaAlpha=0.5, kalmanProcessNoise=0.05, kalmanMeasurementNoise=0.5,
+               splineFit=False, splineControlPoints=8, maxPoseCountJump=5, maxPointJump=10.0,
+               maxConsecutiveRejections=5, displayTolerance=0.1, capacity=256):
+    self.temporalMode = temporalMode
+    self.emaAlpha = emaAlpha
+    self.kalmanProcessNoise = kalmanProcessNoise
+    self.kalmanMeasurementNoise = kalmanMeasurementNoise
+    self.splineFit = splineFit
+    self.splineControlPoints = splineControlPoints
+    self.maxPoseCountJump = maxPoseCountJump
+    self.maxPointJump = maxPointJump
+    # A persistent jump is a real motion: accept it after this many rejected shapes
+    self.maxConsecutiveRejections = maxConsecutiveRejections
+    self.displayTolerance = displayTolerance
+    self.state = np.zeros((capacity, 3))
+    self.displayed = np.zeros((capacity, 3))
+    self.splineBases = {}
+    self.reset()
+    
+  def reset(self):
+    self.count = 0
+    self.displayedCount = 0
+    self.rejectionsInARow = 0
+    self.tipEstimate = None
+    self.tipVariance = 0.0
+    
+  def reserve(self, nbPoints):
+    if nbPoints <= len(self.state):
+      return
+    capacity = max(nbPoints, 2 * len(self.state))
+    for name in ("state", "displayed"):
+      previous = getattr(self, name)
+      grown = np.zeros((capacity, 3))
+      grown[:len(previous)] = previous
+      setattr(self, name, grown)
+      
+  def isOutlier(self, points):
+    nbPoints = len(points)
+    if abs(nbPoints - self.count) > self.maxPoseCountJump:
+      return True
+    common = min(nbPoints, self.count)
+    if common == 0:
+      return False
+    jump = points[:common] - self.state[:common]
+    return np.einsum('ij,ij->i', jump, jump).max() > self.maxPointJump**2
+    
+  def splineBasis(self, nbPoints):
+    """Return the cubic B-spline basis sampled at the poses and its pseudo-inverse, cached per nb of poses."""
+    basis = self.splineBases.get(nbPoints)
+    if basis is None:
+      degree = 3
+      nbControl = min(self.splineControlPoints, nbPoints)
+      t = np.linspace(0.0, 1.0, nbPoints)[:,None]
+      knots = np.concatenate((np.zeros(degree), np.linspace(0.0, 1.0, nbControl - degree + 1), np.ones(degree)))
+      B = ((t >= knots[:-1]) & (t < knots[1:])).astype(float)
+      B[-1, nbControl - 1] = 1.0
+      # Cox-de Boor recursion, empty knot spans contribute zero
+      with np.errstate(divide='ignore', invalid='ignore'):
+        for d in range(1, degree + 1):
+          left = np.nan_to_num((t - knots[:-d-1]) / (knots[d:-1] - knots[:-d-1]))
+          right = np.nan_to_num((knots[d+1:] - t) / (knots[d+1:] - knots[1:-d]))
+          B = left * B[:,:-1] + right * B[:,1:]
+      if len(self.splineBases) > 16:
+        self.splineBases.clear()
+      basis = self.splineBases[nbPoints] = (B, np.linalg.pinv(B))
+    return basis
+    
+  def apply(self, points):
+    points = np.asarray(points, dtype=float)
+    nbPoints = len(points)
+    if nbPoints == 0:
+      return None
+    if self.count and self.rejectionsInARow < self.maxConsecutiveRejections and self.isOutlier(points):
+      self.rejectionsInARow += 1
+      print("Needle shape rejected by the filter")
+      return None
+    self.rejectionsInARow = 0
+    self.reserve(nbPoints)
+    
+    if self.splineFit and nbPoints >= 4 and self.splineControlPoints >= 4:
+      B, pinvB = self.splineBasis(nbPoints)
+      points = B.dot(pinvB.dot(points))
+      
+    state = self.state
+    common = min(nbPoints, self.count)
+    if self.temporalMode == "ema":
+      state[:common] += self.emaAlpha * (points[:common] - state[:common])
+      state[common:nbPoints] = points[common:]
+    elif self.temporalMode == "kalman":
+      # Constant position Kalman filter on the tip, its correction ramped along the needle
+      tip = points[-1]
+      if self.tipEstimate is None:
+        self.tipEstimate = tip.copy()
+        self.tipVariance = self.kalmanMeasurementNoise
+      else:
+        self.tipVariance += self.kalmanProcessNoise
+        gain = self.tipVariance / (self.tipVariance + self.kalmanMeasurementNoise)
+        self.tipEstimate += gain * (tip - self.tipEstimate)
+        self.tipVariance *= 1.0 - gain
+      ramp = np.linspace(0.0, 1.0, nbPoints)[:,None]
+      state[:nbPoints] = points + ramp * (self.tipEstimate - tip)
+    else:
+      state[:nbPoints] = points
+    self.count = nbPoints
+    
+    if nbPoints == self.displayedCount and np.abs(state[:nbPoints] - self.displayed[:nbPoints]).max() < self.displayTolerance:
+      return None
+    self.displayed[:nbPoints] = state[:nbPoints]
+    self.displayedCount = nbPoints
+    return self.displayed[:nbPoints]
+
+
+class TextboxDisplayBinding(object):
+  """Writes values to text boxes at a fixed precision and a capped refresh rate.
+
+  Values are formatted when they are set and compared with the displayed text.
+  Only the text boxes whose text changed are written, at most `refreshRate` times
+  per second; values set in between are coalesced and written by a single-shot timer.
+  """
+
+  def __init__(self, refreshRate=DISPLAY_REFRESH_RATE):
+    self.textboxes = {}
+    self.precisions = {}
+    self.displayedTexts = {}
+    self.pendingTexts = {}
+    self.lastFlushTime = 0.0
+    self.flushTimer = qt.QTimer()
+    self.flushTimer.setSingleShot(True)
+    self.flushTimer.connect('timeout()', self.flush)
+    self.setRefreshRate(refreshRate)
+    
+  def setRefreshRate(self, refreshRate):
+    self.minimumInterval = 1.0 / refreshRate if refreshRate > 0 else 0.0
+    
+  def bind(self, name, textbox, precision=2):
+    self.textboxes[name] = textbox
+    self.precisions[name] = precision
+    self.displayedTexts[name] = textbox.text
+    
+  def formatValue(self, name, value):
+    if self.precisions[name] is None:
+      return str(value)
+    try:
+      return "%.*f" % (self.precisions[name], float(value))
+    except (TypeError, ValueError):
+      return str(value)
+      
+  def setValue(self, name, value):
+    text = self.formatValue(name, value)
+    if text == self.displayedTexts[name]:
+      self.pendingTexts.pop(name, None)
+      return
+    self.pendingTexts[name] = text
+    if self.flushTimer.isActive():
+      return
+    delay = self.lastFlushTime + self.minimumInterval - time.monotonic()
+    if delay <= 0:
+      self.flush()
+    else:
+      self.flushTimer.start(int(delay * 1000) + 1)
+      
+  def flush(self):
+    self.lastFlushTime = time.monotonic()
+    for name, text in self.pendingTexts.items():
+      self.textboxes[name].setText(text)
+      self.displayedTexts[name] = text
+    self.pendingTexts.clear()
+
+
+class SessionProfileStore(object):
+  """Named connection and session profiles persisted in a JSON file.
+
+  Named profiles are only written when they are saved explicitly. The last session
+  is kept in a separate entry of the same file, for recovery after a crash.
+  The whole file is written to a temporary file in the same directory and renamed
+  over the previous one, so a crash while saving never leaves a truncated file.
+  """
+
+  def __init__(self, filePath):
+    self.filePath = filePath
+    self.profiles = {}
+    self.lastProfileName = None
+    self.lastSession = None
+    self.load()
+    
+  def load(self):
+    if not os.path.exists(self.filePath):
+      return
+    try:
+      with open(self.filePath) as profileFile:
+        data = json.load(profileFile)
+    except (IOError, OSError, ValueError) as error:
+      print("Error: Session profiles could not be loaded: ", error)
+      return
+    self.profiles = dict(data.get("profiles", {}))
+    self.lastProfileName = data.get("lastProfile")
+    self.lastSession = data.get("lastSession")
+    
+  def profileNames(self):
+    return sorted(self.profiles)
+    
+  def profile(self, profileName):
+    return self.profiles.get(profileName)
+    
+  def saveProfile(self, profileName, state):
+    self.profiles[profileName] = dict(state)
+    self.lastProfileName = profileName
+    self.save()
+    
+  def saveLastSession(self, state):
+    self.lastSession = dict(state)
+    self.save()
+    
+  def save(self):
+    directory = os.path.dirname(self.filePath)
+    if not os.path.isdir(directory):
+      os.makedirs(directory)
+    temporaryFileDescriptor, temporaryFilePath = tempfile.mkstemp(dir=directory, prefix=".profiles", suffix=".tmp")
+    try:
+      with os.fdopen(temporaryFileDescriptor, "w") as profileFile:
+        json.dump({"lastProfile": self.lastProfileName, "lastSession": self.lastSession, "profiles": self.profiles}, profileFile, indent=2)
+        profileFile.flush()
+        os.fsync(profileFile.fileno())
+      os.replace(temporaryFilePath, self.filePath)
+    except Exception:
+      if os.path.exists(temporaryFilePath):
+        os.remove(temporaryFilePath)
+      raise
+
+
+class FeedbackStreamPublisher(object):
+  """Re-publishes the decoded needle pose and shape frames to local subscribers.
+
+  Frames are packed in the GUI thread and appended to a bounded queue. A background
+  thread accepts subscribers on a Unix socket, or a TCP socket for a host:port
+  address, and fans the frames out with non-blocking sends. A slow subscriber only
+  loses its own oldest unsent frames, so the GUI path cost does not depend on the
+  number or the speed of the subscribers.
+
+  Each frame is a little-endian header followed by float32 values:
+    magic b'SNFB', version (uint8, 2), message type (uint8, 1: pose, 2: shape),
+    reserved (uint16), sequence number (uint32), shape number (uint32),
+    timestamp [s] (float64), number of values (uint32)
+  Pose frames carry dz, dθ, x, y, z, θ and shape frames x, y, z of each point.
+  The shape number is the nb_shape of the received needle shape, so subscribers
+  can match shapes with the estimation instructions; it is 0xFFFFFFFF in pose
+  frames and when the shape was received without a number.
+  """
+
+  headerFormat = struct.Struct("<4sBBHIIdI")
+  VERSION = 2
+  POSE_MESSAGE = 1
+  SHAPE_MESSAGE = 2
+  NO_SHAPE_NUMBER = 0xFFFFFFFF
+
+  def __init__(self, maxQueuedFrames=256, maxSubscriberFrames=64):
+    self.maxQueuedFrames = maxQueuedFrames
+    self.frames = collections.deque(maxlen=maxQueuedFrames)
+    self.maxSubscriberFrames = maxSubscriberFrames
+    self.sequence = 0
+    self.address = None
+    self.wakeupSender = None
+    self.stopEvent = None
+    self.thread = None
+    self.running = False
+    
+  def isRunning(self):
+    return self.running
+    
+  def start(self, address):
+    self.stop()
+    host, separator, port = address.rpartition(":")
+    isTcpAddress = bool(separator) and port.isdigit()
+    if not isTcpAddress and not hasattr(socket, "AF_UNIX"):
+      raise ValueError("Expected a host:port stream address, got " + address)
+    unixSocketPath = None
+    socketFileId = None
+    if isTcpAddress:
+      server = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+      server.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+      server.bind((host or "localhost", int(port)))
+    else:
+      # A socket file left by a crashed session would prevent binding, any other file
+      # and the socket of a running publisher are kept
+      try:
+        existingMode = os.lstat(address).st_mode
+      except FileNotFoundError:
+        existingMode = None
+      if existingMode is not None:
+        if not stat.S_ISSOCK(existingMode):
+          raise ValueError("Stream address " + address + " is an existing file, not a socket")
+        probe = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        try:
+          probe.connect(address)
+        except ConnectionRefusedError:
+          os.remove(address)
+        else:
+          raise ValueError("Stream address " + address + " is in use by another publisher")
+        finally:
+          probe.close()
+      server = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+      server.bind(address)
+      unixSocketPath = address
+      # Identify the bound socket file, a restarted publisher may bind a new one at the same path
+      socketFileStat = os.lstat(address)
+      socketFileId = (socketFileStat.st_dev, socketFileStat.st_ino)
+    server.listen(8)
+    server.setblocking(False)
+    wakeupReceiver, wakeupSender = socket.socketpair()
+    wakeupReceiver.setblocking(False)
+    wakeupSender.setblocking(False)
+    
+    # Each worker thread owns its sockets, frame queue and stop event, so that a thread
+    # still exiting after a restart never touches the ones of the new thread
+    self.address = address
+    self.frames = collections.deque(maxlen=self.maxQueuedFrames)
+    self.wakeupSender = wakeupSender
+    self.stopEvent = threading.Event()
+    self.running = True
+    self.thread = threading.Thread(target=self.run, name="FeedbackStreamPublisher",
+                                   args=(server, unixSocketPath, socketFileId, wakeupReceiver, wakeupSender, self.frames, self.stopEvent))
+    self.thread.daemon = True
+    self.thread.start()
+    
+  def stop(self):
+    if not self.running:
+      return
+    self.running = False
+    self.stopEvent.set()
+    self.wakeup()
+    # The thread closes its sockets and removes its socket file when it exits
+    self.thread.join(1.0)
+    if self.thread.is_alive():
+      print("Warning: Feedback stream thread is still exiting")
+    self.thread = None
+    
+  def wakeup(self):
+    try:
+      self.wakeupSender.send(b"\0")
+    except (AttributeError, OSError):
+      # Wakeup already pending, or the publisher is stopping
+      pass
+      
+  def publish(self, messageType, values, shapeNumber=None):
+    if not self.running:
+      return
+    values = np.ascontiguousarray(values, dtype='<f4')
+    self.sequence = (self.sequence + 1) & 0xFFFFFFFF
+    shapeNumber = self.NO_SHAPE_NUMBER if shapeNumber is None else shapeNumber & 0xFFFFFFFF
+    header = self.headerFormat.pack(b"SNFB", self.VERSION, messageType, 0, self.sequence, shapeNumber, time.time(), values.size)
+    self.frames.append(header + values.tobytes())
+    self.wakeup()
+    
+  def publishPose(self, dz, dtheta, x, y, z, theta):
+    self.publish(self.POSE_MESSAGE, (dz, dtheta, x, y, z, theta))
+    
+  def publishShape(self, points, shapeNumber=None):
+    self.publish(self.SHAPE_MESSAGE, points, shapeNumber)
+    
+  def run(self, server, unixSocketPath, socketFileId, wakeupReceiver, wakeupSender, queuedFrames, stopEvent):
+    selector = selectors.DefaultSelector()
+    selector.register(server, selectors.EVENT_READ)
+    selector.register(wakeupReceiver, selectors.EVENT_READ)
+    # Pending frames, offset in the first frame and selector events of each subscriber
+    subscribers = {}
+    
+    def dropSubscriber(subscriber):
+      selector.unregister(subscriber)
+      subscriber.close()
+      del subscribers[subscriber]
+      
+    try:
+      while not stopEvent.is_set():
+        for key, events in selector.select(timeout=1.0):
+          connection = key.fileobj
+          if connection is server:
+            try:
+              subscriber, unusedAddress = server.accept()
+            except OSError:
+              continue
+            subscriber.setblocking(False)
+            subscribers[subscriber] = [collections.deque(), 0, selectors.EVENT_READ]
+            selector.register(subscriber, selectors.EVENT_READ)
+          elif connection is wakeupReceiver:
+            try:
+              while connection.recv(4096):
+                pass
+            except OSError:
+              pass
+          elif connection in subscribers and events & selectors.EVENT_READ:
+            # Subscribers do not send data: a readable socket has been closed
+            try:
+              data = connection.recv(4096)
+            except OSError:
+              data = b""
+            if not data:
+              dropSubscriber(connection)
+              
+        while queuedFrames:
+          frame = queuedFrames.popleft()
+          for pending in subscribers.values():
+            pending[0].append(frame)
+            if len(pending[0]) > self.maxSubscriberFrames:
+              # Drop the oldest frame not yet started, the stream framing stays intact
+              del pending[0][1 if pending[1] > 0 else 0]
+              
+        for subscriber, pending in list(subscribers.items()):
+          frames = pending[0]
+          try:
+            while frames:
+              sent = subscriber.send(memoryview(frames[0])[pending[1]:])
+              pending[1] += sent
+              if pending[1] < len(frames[0]):
+                break
+              frames.popleft()
+              pending[1] = 0
+          except BlockingIOError:
+            pass
+          except OSError:
+            dropSubscriber(subscriber)
+            continue
+          events = selectors.EVENT_READ | selectors.EVENT_WRITE if frames else selectors.EVENT_READ
+          if events != pending[2]:
+            selector.modify(subscriber, events)
+            pending[2] = events
+    finally:
+      for subscriber in list(subscribers):
+        subscriber.close()
+      selector.close()
+      server.close()
+      wakeupReceiver.close()
+      wakeupSender.close()
+      # Remove the socket file only if it is still the one bound for this thread
+      if socketFileId is not None:
+        try:
+          socketFileStat = os.lstat(unixSocketPath)
+          if (socketFileStat.st_dev, socketFileStat.st_ino) == socketFileId:
+            os.remove(unixSocketPath)
+        except OSError:
+          pass
+
+
+class InstructionFeed(object):
+  """Validated instructions of the trajectory estimation model and their timing.
+
+  Messages are "<shape nb>;<dz>;<dθ>[;<instruction>]", where the shape number is the
+  needle shape the model output was computed from. Its difference with the newest
+  received shape number gives the model lag in frames.
+  """
+
+  def __init__(self):
+    self.shapeNumber = None
+    self.dz = None
+    self.dtheta = None
+    self.instruction = None
+    self.receivedTime = None
+    self.meanInterval = None
+    self.latestShapeNumber = None
+    
+  @staticmethod
+  def parse(text):
+    fields = text.strip().split(";")
+    if len(fields) not in (3, 4):
+      raise ValueError("expected '<shape nb>;<dz>;<dθ>[;<instruction>]', got '" + text + "'")
+    shapeNumber = int(fields[0])
+    dz = float(fields[1])
+    dtheta = float(fields[2])
+    if shapeNumber < 0 or not np.isfinite(dz) or not np.isfinite(dtheta):
+      raise ValueError("out of range values in '" + text + "'")
+    instruction = fields[3].strip() if len(fields) == 4 else ""
+    return shapeNumber, dz, dtheta, instruction
+    
+  def update(self, text, now=None):
+    shapeNumber, dz, dtheta, instruction = self.parse(text)
+    now = time.monotonic() if now is None else now
+    if self.receivedTime is not None:
+      # Smoothed interval between instructions for the update rate
+      interval = now - self.receivedTime
+      self.meanInterval = interval if self.meanInterval is None else 0.8 * self.meanInterval + 0.2 * interval
+    self.shapeNumber, self.dz, self.dtheta, self.instruction = shapeNumber, dz, dtheta, instruction
+    self.receivedTime = now
+    
+  def hasInstruction(self):
+    return self.receivedTime is not None
+    
+  def setLatestShapeNumber(self, shapeNumber):
+    self.latestShapeNumber = shapeNumber
+    
+  def age(self, now=None):
+    if self.receivedTime is None:
+      return None
+    return (time.monotonic() if now is None else now) - self.receivedTime
+    
+  def rate(self, now=None):
+    if not self.meanInterval:
+      return 0.0
+    # Decays while no instruction is received, instead of holding the last mean rate
+    return 1.0 / max(self.meanInterval, self.age(now))
+    
+  def lag(self):
+    if self.shapeNumber is None or self.latestShapeNumber is None:
+      return None
+    return max(0, self.latestShapeNumber - self.shapeNumber)
+
+
+class ProfilingSession(object):
+  """On demand cProfile and tracemalloc capture of the wrapped callbacks.
+
+  Callbacks are wrapped once when they are connected; outside of a profiling
+  window the wrapper only checks a flag. `stop` writes the cProfile stats, the
+  tracemalloc snapshot and a summary of the top hot functions and allocation
+  sites to the output directory.
+  """
+
+  def __init__(self, outputDirectory, topCount=25):
+    self.outputDirectory = outputDirectory
+    self.topCount = topCount
+    self.profile = None
+    self.depth = 0
+    self.callCount = 0
+    self.startTime = None
+    self.startedTracemalloc = False
+    
+  def isActive(self):
+    return self.profile is not None
+    
+  def wrap(self, callback):
+    @functools.wraps(callback)
+    def profiledCallback(*args):
+      if self.profile is None:
+        return callback(*args)
+      # Nested wrapped callbacks run inside the outer profiled call
+      self.depth += 1
+      self.callCount += 1
+      if self.depth == 1:
+        self.profile.enable()
+      try:
+        return callback(*args)
+      finally:
+        if self.depth == 1 and self.profile is not None:
+          self.profile.disable()
+        self.depth -= 1
+    return profiledCallback
+    
+  def start(self):
+    if self.profile is not None:
+      return
+    self.callCount = 0
+    self.startTime = time.time()
+    self.startedTracemalloc = not tracemalloc.is_tracing()
+    if self.startedTracemalloc:
+      tracemalloc.start(25)
+    self.profile = cProfile.Profile()
+    
+  def stop(self):
+    """End the profiling window and return the path of the written summary."""
+    profile, self.profile = self.profile, None
+    duration = time.time() - self.startTime
+    snapshot = tracemalloc.take_snapshot().filter_traces((tracemalloc.Filter(False, tracemalloc.__file__),))
+    if self.startedTracemalloc:
+      tracemalloc.stop()
+      
+    if not os.path.isdir(self.outputDirectory):
+      os.makedirs(self.outputDirectory)
+    basePath = os.path.join(self.outputDirectory, "profile_" + time.strftime("%Y%m%d-%H%M%S"))
+    profile.dump_stats(basePath + ".prof")
+    snapshot.dump(basePath + ".tracemalloc")
+    
+    summary = io.StringIO()
+    summary.write("Profiling window: %.1f s, %d profiled callbacks\n\n" % (duration, self.callCount))
+    summary.write("Hot functions (cumulative time)\n")
+    try:
+      pstats.Stats(profile, stream=summary).sort_stats("cumulative").print_stats(self.topCount)
+    except TypeError:
+      # No callback ran during the window
+      summary.write("No profiled calls\n")
+    summary.write("\nAllocation sites (size)\n")
+    for statistic in snapshot.statistics("lineno")[:self.topCount]:
+      summary.write(str(statistic) + "\n")
+    with open(basePath + "_summary.txt", "w") as summaryFile:
+      summaryFile.write(summary.getvalue())
+    return basePath + "_summary.txt"
+
+
+class SensorizedNeedleModuleTest(ScriptedLoadableModuleTest):
+  """
+  This is the test case for your scripted module.
+  Uses ScriptedLoadableModuleTest base class, available at:
+  https://github.com/Slicer/Slicer/blob/master/Base/Python/slicer/ScriptedLoadableModule.py
+  """
+
+  def setUp(self):
+    """ Do whatever is needed to reset the state - typically a scene clear will be enough.
+    """
+    slicer.mrmlScene.Clear(0)
+
+  def runTest(self):
+    """Run as few or as many tests as needed here.
+    """
+    self.setUp()
+    self.test_SplineBasis()
+    self.setUp()
+    self.test_OutlierRejection()
+    self.setUp()
+    self.test_DisplayTolerance()
+    self.setUp()
+    self.test_InstructionParsing()
+
+  def needleShape(self, nbPoints, offset=0.0):
+    y = np.linspace(0.0, 100.0, nbPoints)
+    return np.stack((offset + 0.002 * y**2, y, 0.001 * y**2), axis=1)
+
+  def test_SplineBasis(self):
+    self.delayDisplay("Testing the needle shape B-spline basis")
+    shapeFilter = NeedleShapeFilter(splineFit=True, splineControlPoints=8)
+    B, pinvB = shapeFilter.splineBasis(40)
+    self.assertEqual(B.shape, (40, 8))
+    # Partition of unity at every pose, including the needle tip
+    self.assertTrue(np.allclose(B.sum(axis=1), 1.0))
+    self.assertTrue((B >= 0.0).all())
+    # A quadratic lies in the cubic spline space, so the fit reproduces it exactly
+    points = self.needleShape(40)
+    self.assertTrue(np.allclose(B.dot(pinvB.dot(points)), points))
+    self.assertIs(shapeFilter.splineBasis(40)[0], B)
+    self.delayDisplay("Test passed")
+
+  def test_OutlierRejection(self):
+    self.delayDisplay("Testing the needle shape outlier rejection")
+    shapeFilter = NeedleShapeFilter(maxPointJump=10.0, maxConsecutiveRejections=3)
+    self.assertIsNotNone(shapeFilter.apply(self.needleShape(20)))
+    # A single jump is rejected and the previous shape is kept
+    self.assertIsNone(shapeFilter.apply(self.needleShape(20, offset=50.0)))
+    self.assertIsNotNone(shapeFilter.apply(self.needleShape(20, offset=1.0)))
+    # A pose count jump is rejected as well
+    self.assertIsNone(shapeFilter.apply(self.needleShape(30, offset=1.0)))
+    # A persistent jump is accepted after maxConsecutiveRejections rejected shapes
+    shapeFilter.reset()
+    shapeFilter.apply(self.needleShape(20))
+    for rejection in range(3):
+      self.assertIsNone(shapeFilter.apply(self.needleShape(20, offset=50.0)))
+    displayed = shapeFilter.apply(self.needleShape(20, offset=50.0))
+    self.assertIsNotNone(displayed)
+    self.assertTrue(np.allclose(displayed, self.needleShape(20, offset=50.0)))
+    self.delayDisplay("Test passed")
+
+  def test_DisplayTolerance(self):
+    self.delayDisplay("Testing the needle shape display tolerance")
+    shapeFilter = NeedleShapeFilter(displayTolerance=0.1)
+    self.assertIsNotNone(shapeFilter.apply(self.needleShape(20)))
+    self.assertIsNone(shapeFilter.apply(self.needleShape(20, offset=0.05)))
+    displayed = shapeFilter.apply(self.needleShape(20, offset=0.2))
+    self.assertIsNotNone(displayed)
+    self.assertTrue(np.allclose(displayed, self.needleShape(20, offset=0.2)))
+    self.delayDisplay("Test passed")
+
+  def test_InstructionParsing(self):
+    self.delayDisplay("Testing the estimation instruction parsing")
+    self.assertEqual(InstructionFeed.parse("12;1.5;-0.25"), (12, 1.5, -0.25, ""))
+    self.assertEqual(InstructionFeed.parse(" 3;0;2;Rotate needle \n"), (3, 0.0, 2.0, "Rotate needle"))
+    for text in ("", "1;2", "1;2;3;4;5", "a;1;2", "1;b;2", "-1;0;0", "1;nan;0", "1;0;inf"):
+      with self.assertRaises(ValueError):
+        InstructionFeed.parse(text)
+    self.delayDisplay("Test passed")